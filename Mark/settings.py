@@ -53,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'image.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'Mark.urls'
@@ -84,6 +85,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'OPTIONS': {
+            # 编码worker进程和uwsgi进程同时写库时等待锁的秒数
+            'timeout': 20,
+        },
     }
 }
 
@@ -132,6 +137,53 @@ STATICFILES_DIRS = (
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media/")
+# 下载链接指向MEDIA_ROOT下以内容SHA-256命名的文件(c/前两位/哈希.扩展名), 内容不变, 由nginx长期缓存并直接提供
+MEDIA_CONTENT_DIR = 'c'
+MEDIA_CACHE_SECONDS = 365 * 24 * 3600
+# 由nginx提供/media/, 仅在没有nginx时(如runserver调试)设为True由Django提供
+MEDIA_SERVE = DEBUG
+# 下载链接的地址, 指向nginx(mark_nginx.conf中的listen端口)而不是uwsgi的HOST, 最后不要加"/"; 由Django提供/media/时同HOST
+MEDIA_HOST = HOST if MEDIA_SERVE else 'http://192.168.95.221'
 
 # 跨域设置
-CORS_ORIGIN_ALLOW_ALL = True
\ No newline at end of file
+CORS_ORIGIN_ALLOW_ALL = True
+
+# 水印载荷: 编码时把副本编号和校验码写入像素低4位, 解码时直接读出编号并用该密钥校验, 读不出(如图片被缩放)时再用相似度检索
+PAYLOAD_KEY = SECRET_KEY
+
+# 指纹索引, 解码时只对最相近的DECODE_CANDIDATES张图片计算相似度
+FINGERPRINT_INDEX = os.path.join(BASE_DIR, 'data', 'fingerprint.idx')
+DECODE_CANDIDATES = 30
+
+# 解码排序: 先用粗排(hash或correlation)保留前DECODE_TOP_K张, 再用精排(entropy或ssim)打分, 可在请求中用coarse, fine, k覆盖
+DECODE_COARSE = 'hash'
+DECODE_FINE = 'entropy'
+DECODE_TOP_K = 6
+# 精排打分的进程池大小和每个进程每次处理的候选数, 每个uwsgi进程(Mark.ini中processes=4)各有一个进程池, 候选不超过2批时在当前进程打分
+DECODE_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 4))
+DECODE_CHUNK_SIZE = 4
+
+# 特征缓存, 编码时预先计算每张marked图片缩放后的特征, 解码时无需再读取和缩放候选图片
+FEATURE_STORE = os.path.join(BASE_DIR, 'data', 'features.arena')
+FEATURE_SIZE = (128, 128)
+
+# 异步编码: 为True时/image/encode/立即返回任务编号, 由python manage.py encode_worker启动的进程池完成编码, 可在请求中用async覆盖
+ENCODE_ASYNC = False
+ENCODE_WORKERS = os.cpu_count()
+# marked图片的输出格式(png, webp无损; jpeg有损, 会破坏低4位中的水印)和压缩预设(fast, balanced, small), 可在请求中用format, preset覆盖
+ENCODE_FORMAT = 'png'
+ENCODE_PRESET = 'fast'
+# 异步编码任务的原图暂存目录, 任务结束后删除
+ENCODE_JOB_ROOT = os.path.join(BASE_DIR, 'data', 'jobs')
+# 空闲worker轮询任务队列的间隔秒数, 以及运行超过多少秒的任务视为worker已退出并重新排队
+ENCODE_POLL_INTERVAL = 1
+ENCODE_JOB_TIMEOUT = 600
+
+# 视频库帧指纹索引, 用于查找截图来自哪个视频的哪一帧, 通过python -m utils.luckyen.copyright.similarity.video.library添加视频
+VIDEO_LIBRARY = os.path.join(BASE_DIR, 'data', 'videos')
+VIDEO_SEARCH_TOP_K = 10
+# 请求中k的上限, 更大的k按上限返回
+VIDEO_SEARCH_MAX_K = 100
+
+# Prometheus指标, 每个uwsgi进程和编码进程把指标写入METRICS_DIR, 在/metrics汇总, uwsgi主进程启动时清空该目录(见Mark/wsgi.py)
+METRICS_DIR = os.path.join(BASE_DIR, 'data', 'metrics')
@@ -13,14 +13,19 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include, re_path
-from django.views.static import serve
 
-from Mark.settings import MEDIA_ROOT
+from image.metrics import metrics_view
+from image.views import media_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('image/', include('image.urls')),
-    re_path(r'^media/(?P<path>.*)$', serve, {"document_root": MEDIA_ROOT}),
+    path('metrics', metrics_view, name='metrics'),
 ]
+
+# /media/ is served by nginx, see mark_nginx.conf
+if settings.MEDIA_SERVE:
+    urlpatterns.append(re_path(r'^media/(?P<path>.*)$', media_view, name='media'))
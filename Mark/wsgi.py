@@ -7,10 +7,21 @@ For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/wsgi/
 """
 
+import glob
 import os
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Mark.settings')
 
+from Mark.settings import METRICS_DIR  # noqa: E402
+
+# The uWSGI master loads this file once before forking the workers (no lazy-apps), every worker then writes its
+# metrics to the multiprocess directory. It must be set before prometheus_client is imported, and the samples of
+# the workers of a previous run are removed so that their counters are not merged into this one.
+os.environ.setdefault('prometheus_multiproc_dir', METRICS_DIR)
+os.makedirs(os.environ['prometheus_multiproc_dir'], exist_ok=True)
+for path in glob.glob(os.path.join(os.environ['prometheus_multiproc_dir'], '*.db')):
+    os.remove(path)
+
 application = get_wsgi_application()
@@ -1,3 +1,19 @@
 from django.contrib import admin
 
+from .models import MarkedImage, EncodeJob
+
 # Register your models here.
+
+
+@admin.register(MarkedImage)
+class MarkedImageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'path', 'width', 'height', 'variant', 'created')
+    search_fields = ('id', 'source_hash', 'path')
+    date_hierarchy = 'created'
+
+
+@admin.register(EncodeJob)
+class EncodeJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'variants', 'created', 'started', 'finished')
+    list_filter = ('status',)
+    search_fields = ('id', 'source_hash')
@@ -0,0 +1,63 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from Mark.settings import ENCODE_WORKERS, ENCODE_POLL_INTERVAL, ENCODE_JOB_TIMEOUT, METRICS_DIR
+
+# The workers write their metrics next to the ones of the uWSGI workers, start them after uWSGI which clears them.
+# Set when the command is loaded, before the system checks import the URLs and so prometheus_client
+os.environ.setdefault('prometheus_multiproc_dir', METRICS_DIR)
+os.makedirs(os.environ['prometheus_multiproc_dir'], exist_ok=True)
+
+
+def work(poll_interval):
+    # Every process needs its own database connection
+    connections.close_all()
+    # Records the stage timings of the jobs with the metrics of the service
+    import image.metrics  # noqa: F401
+    from image.services import claim_encode_job, run_encode_job
+    while True:
+        job = claim_encode_job()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        logging.info('Running encode job: %s', job.id)
+        run_encode_job(job)
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of local worker processes for the asynchronous encode jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--processes', type=int, default=ENCODE_WORKERS, help='# of worker processes, default: ENCODE_WORKERS')
+        parser.add_argument('--poll', type=float, default=ENCODE_POLL_INTERVAL, help='seconds between two polls of an idle worker, default: ENCODE_POLL_INTERVAL')
+        parser.add_argument('--timeout', type=int, default=ENCODE_JOB_TIMEOUT, help='seconds after which a running job is requeued, default: ENCODE_JOB_TIMEOUT')
+
+    def handle(self, *args, **options):
+        from image.services import requeue_stale_encode_jobs
+        logging.basicConfig(level=logging.INFO)
+        connections.close_all()
+        processes = dict()
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            while True:
+                # Requeue the jobs of dead workers, and replace the workers
+                requeue_stale_encode_jobs(options['timeout'])
+                connections.close_all()
+                for i in range(options['processes']):
+                    if i not in processes or not processes[i].is_alive():
+                        processes[i] = multiprocessing.Process(target=work, args=(options['poll'],), daemon=True)
+                        processes[i].start()
+                        self.stdout.write('Started encode worker {}: {}'.format(i, processes[i].pid))
+                time.sleep(options['poll'] * 10)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes.values():
+                process.terminate()
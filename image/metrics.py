@@ -0,0 +1,44 @@
+import os
+import time
+
+from django.http import HttpResponse
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+from utils.luckyen.copyright import metrics
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram('mark_stage_seconds', 'Latency of the encode and decode stages', ['stage'], buckets=BUCKETS)
+REQUEST_SECONDS = Histogram('mark_request_seconds', 'Latency of the API requests', ['view'], buckets=BUCKETS)
+REQUESTS = Counter('mark_requests_total', 'API requests', ['view', 'status'])
+
+metrics.listen(lambda stage, seconds: STAGE_SECONDS.labels(stage).observe(seconds))
+
+
+class MetricsMiddleware:
+    """
+    Count and time the requests by URL name, the metrics endpoint itself is left out
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        t = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name else None
+        if view is not None and view != 'metrics':
+            REQUEST_SECONDS.labels(view).observe(time.perf_counter() - t)
+            REQUESTS.labels(view, str(response.status_code)).inc()
+        return response
+
+
+def metrics_view(request):
+    # Every uWSGI worker writes its samples to the multiprocess directory, they are merged here
+    if os.environ.get('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.3 on 2026-10-18 11:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarkedImage',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='编号')),
+                ('source_hash', models.CharField(db_index=True, max_length=64, verbose_name='原图SHA-256')),
+                ('width', models.PositiveIntegerField(verbose_name='宽')),
+                ('height', models.PositiveIntegerField(verbose_name='高')),
+                ('variant', models.PositiveSmallIntegerField(verbose_name='副本序号')),
+                ('path', models.CharField(help_text='相对于MEDIA_ROOT', max_length=255, unique=True, verbose_name='存储路径')),
+                ('dhash', models.CharField(db_index=True, max_length=16, verbose_name='dHash')),
+                ('phash', models.CharField(db_index=True, max_length=16, verbose_name='pHash')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '水印图片',
+                'verbose_name_plural': '水印图片',
+                'indexes': [models.Index(fields=['source_hash', 'variant'], name='image_marke_source__5626d0_idx')],
+            },
+        ),
+    ]
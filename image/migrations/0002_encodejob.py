@@ -0,0 +1,33 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncodeJob',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='编号')),
+                ('status', models.CharField(choices=[('pending', '等待'), ('running', '运行'), ('done', '完成'), ('failed', '失败')], default='pending', max_length=8, verbose_name='状态')),
+                ('source', models.CharField(help_text='相对于MEDIA_ROOT', max_length=255, verbose_name='原图路径')),
+                ('source_hash', models.CharField(max_length=64, verbose_name='原图SHA-256')),
+                ('variants', models.PositiveSmallIntegerField(default=3, verbose_name='副本数')),
+                ('result', models.TextField(blank=True, help_text='JSON', verbose_name='下载列表')),
+                ('error', models.TextField(blank=True, verbose_name='错误信息')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+            ],
+            options={
+                'verbose_name': '编码任务',
+                'verbose_name_plural': '编码任务',
+                'indexes': [models.Index(fields=['status', 'created'], name='image_encod_status_1ebb33_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0002_encodejob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='encodejob',
+            name='source',
+            field=models.CharField(help_text='相对于ENCODE_JOB_ROOT', max_length=255, verbose_name='原图路径'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0003_auto_20261018_1240'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encodejob',
+            name='format',
+            field=models.CharField(default='png', max_length=8, verbose_name='输出格式'),
+        ),
+        migrations.AddField(
+            model_name='encodejob',
+            name='preset',
+            field=models.CharField(default='fast', max_length=8, verbose_name='压缩预设'),
+        ),
+    ]
@@ -1,3 +1,65 @@
 from django.db import models
 
 # Create your models here.
+
+
+class MarkedImage(models.Model):
+    id = models.CharField('编号', max_length=32, primary_key=True)
+    source_hash = models.CharField('原图SHA-256', max_length=64, db_index=True)
+    width = models.PositiveIntegerField('宽')
+    height = models.PositiveIntegerField('高')
+    variant = models.PositiveSmallIntegerField('副本序号')
+    path = models.CharField('存储路径', max_length=255, unique=True, help_text='相对于MEDIA_ROOT')
+    dhash = models.CharField('dHash', max_length=16, db_index=True)
+    phash = models.CharField('pHash', max_length=16, db_index=True)
+    created = models.DateTimeField('创建时间', auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = '水印图片'
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['source_hash', 'variant']),
+        ]
+
+    def __str__(self):
+        return self.id
+
+    @property
+    def fingerprint(self):
+        return (int(self.dhash, 16) << 64) | int(self.phash, 16)
+
+
+class EncodeJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '等待'),
+        (RUNNING, '运行'),
+        (DONE, '完成'),
+        (FAILED, '失败'),
+    )
+
+    id = models.CharField('编号', max_length=32, primary_key=True)
+    status = models.CharField('状态', max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    source = models.CharField('原图路径', max_length=255, help_text='相对于ENCODE_JOB_ROOT')
+    source_hash = models.CharField('原图SHA-256', max_length=64)
+    variants = models.PositiveSmallIntegerField('副本数', default=3)
+    format = models.CharField('输出格式', max_length=8, default='png')
+    preset = models.CharField('压缩预设', max_length=8, default='fast')
+    result = models.TextField('下载列表', blank=True, help_text='JSON')
+    error = models.TextField('错误信息', blank=True)
+    created = models.DateTimeField('创建时间', auto_now_add=True)
+    started = models.DateTimeField('开始时间', null=True, blank=True)
+    finished = models.DateTimeField('结束时间', null=True, blank=True)
+
+    class Meta:
+        verbose_name = '编码任务'
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['status', 'created']),
+        ]
+
+    def __str__(self):
+        return self.id
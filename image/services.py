@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import string
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from PIL import Image
+
+from Mark.settings import MEDIA_ROOT, MEDIA_URL, MEDIA_CONTENT_DIR, MEDIA_HOST, FINGERPRINT_INDEX, DECODE_CANDIDATES, FEATURE_STORE, FEATURE_SIZE, \
+    DECODE_WORKERS, DECODE_CHUNK_SIZE, ENCODE_JOB_ROOT, VIDEO_LIBRARY, PAYLOAD_KEY, ENCODE_FORMAT, ENCODE_PRESET
+
+from image.models import MarkedImage, EncodeJob
+from utils.luckyen.copyright.metrics import timer
+from utils.luckyen.copyright.watermark.image import payload
+from utils.luckyen.copyright.watermark.image.codec import Codec
+from utils.luckyen.copyright.watermark.image.pipeline import EncodePipeline
+from utils.luckyen.copyright.watermark.image.ssis import SSIS
+from utils.luckyen.copyright.similarity.image.feature import FeatureStore, feature
+from utils.luckyen.copyright.similarity.image.fingerprint import FingerprintIndex, fingerprint
+from utils.luckyen.copyright.similarity.image.parallel import ParallelScorer
+from utils.luckyen.copyright.similarity.video.library import VideoLibrary
+
+fingerprint_index = FingerprintIndex(FINGERPRINT_INDEX)
+feature_store = FeatureStore(FEATURE_STORE, FEATURE_SIZE)
+scorer = ParallelScorer(FEATURE_STORE, FEATURE_SIZE, MEDIA_ROOT, DECODE_WORKERS, DECODE_CHUNK_SIZE)
+video_library = VideoLibrary(VIDEO_LIBRARY)
+
+# Marked image IDs are strings of digits, carried as integers by the payload
+ID_LENGTH = 10
+
+if not os.path.exists(ENCODE_JOB_ROOT):
+    os.makedirs(ENCODE_JOB_ROOT, exist_ok=True)
+
+
+def create_random_str(num=10):
+    return ''.join(random.choice(string.digits) for _ in range(num))
+
+
+def create_marked_images(src_image_data, source_hash, num, extension, length=ID_LENGTH):
+    """
+    Insert the records of the marked variants of a source image under new random IDs, before the variants are built
+    since the IDs are merged into them. The insert reserves the IDs: when another encode took one of them meanwhile,
+    the insert fails as a whole and new IDs are drawn.
+    :return: the list of MarkedImage records
+    """
+    # The variants only differ in the low nibble, they share the fingerprint of the source
+    key = fingerprint(src_image_data)
+    while True:
+        id_list = sorted(create_random_str(length) for _ in range(num))
+        records = [MarkedImage(
+            id=_id,
+            source_hash=source_hash,
+            width=src_image_data.size[0],
+            height=src_image_data.size[1],
+            variant=i,
+            path='marked_{id}.{ext}'.format(id=_id, ext=extension),
+            dhash='{:016x}'.format(key >> 64),
+            phash='{:016x}'.format(key & 0xFFFFFFFFFFFFFFFF)
+        ) for i, _id in enumerate(id_list)]
+        try:
+            with transaction.atomic():
+                return MarkedImage.objects.bulk_create(records)
+        except IntegrityError:
+            logging.info('Marked image IDs already taken, drawing new ones')
+
+
+def get_candidate_marked_image(image, k=DECODE_CANDIDATES):
+    candidates = fingerprint_index.search(image, k)
+    records = MarkedImage.objects.in_bulk([name for _, name in candidates], field_name='path')
+    return [(d, name) for d, name in candidates if name in records], records
+
+
+def get_marked_image_by_payload(image):
+    """
+    Read the ID merged into a marked image, in one pass whatever the number of marked images
+    :return: the MarkedImage, or None if the image carries no valid payload, e.g. it was resized
+    """
+    _id = SSIS.extract_payload(image, PAYLOAD_KEY)
+    if _id is None:
+        return None
+    return MarkedImage.objects.filter(id=str(_id).zfill(ID_LENGTH)).first()
+
+
+def load_feature(name, path=MEDIA_ROOT):
+    cached = feature_store.get(name)
+    if cached is None:
+        cached = feature('{path}{name}'.format(path=path, name=name), FEATURE_SIZE)
+    return cached
+
+
+def publish_marked_image(file_path):
+    """
+    Link a marked image under the SHA-256 of its content, the path never changes content so it can be cached forever
+    :return: the content addressed path, relative to MEDIA_ROOT
+    """
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    digest = content_hash.hexdigest()
+    name = '{dir}/{prefix}/{digest}{ext}'.format(dir=MEDIA_CONTENT_DIR, prefix=digest[:2], digest=digest, ext=os.path.splitext(file_path)[1])
+    target = os.path.join(MEDIA_ROOT, name)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            # A hard link costs no disk space, the file keeps its name for the feature store and the fingerprint index
+            os.link(file_path, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(file_path, target)
+    return name
+
+
+def media_url(path):
+    """
+    :param path: a path relative to MEDIA_ROOT
+    :return: its download URL, served by nginx
+    """
+    return '{host}{media_url}{path}'.format(host=MEDIA_HOST, media_url=MEDIA_URL, path=path)
+
+
+def encode_marked_images(src_image_data, source_hash, variants=3, codec=None):
+    """
+    Build, save and register the marked variants of a source image
+    :param src_image_data: the decoded source image
+    :param codec: the Codec saving the variants, default: ENCODE_FORMAT and ENCODE_PRESET
+    :return: the download URLs of the variants
+    """
+    codec = codec or Codec(ENCODE_FORMAT, ENCODE_PRESET)
+    with timer('encode.register'):
+        records = create_marked_images(src_image_data, source_hash, variants, codec.extension)
+    file_name_list = [i.path for i in records]
+    file_path_list = ['{media_root}{file_name}'.format(media_root=MEDIA_ROOT, file_name=i) for i in file_name_list]
+    features = list()
+    content_paths = dict()
+
+    def add_feature(file_path, image):
+        with timer('encode.feature'):
+            features.append((os.path.basename(file_path), feature(image, FEATURE_SIZE)))
+        with timer('encode.publish'):
+            content_paths[file_path] = publish_marked_image(file_path)
+
+    payloads = [payload.encode(int(i.id), PAYLOAD_KEY) for i in records]
+    try:
+        EncodePipeline(src_image_data).run(file_path_list, callback=add_feature, payloads=payloads, codec=codec)
+    except BaseException:
+        MarkedImage.objects.filter(id__in=[i.id for i in records]).delete()
+        raise
+    with timer('encode.index'):
+        feature_store.add_many(features)
+        fingerprint_index.add_many([(i.path, i.fingerprint) for i in records])
+    return [media_url(content_paths[i]) for i in file_path_list]
+
+
+def claim_encode_job():
+    """
+    Atomically move the oldest pending job to running, safe with many worker processes
+    :return: the claimed job, or None if there is no pending job
+    """
+    pending = EncodeJob.objects.filter(status=EncodeJob.PENDING).order_by('created').values_list('id', flat=True)
+    for job_id in pending[:8]:
+        if EncodeJob.objects.filter(id=job_id, status=EncodeJob.PENDING).update(status=EncodeJob.RUNNING, started=timezone.now()):
+            return EncodeJob.objects.get(id=job_id)
+    return None
+
+
+def requeue_stale_encode_jobs(timeout):
+    """
+    Put back the jobs left running by a worker that died
+    :param timeout: seconds after which a running job is considered stale
+    """
+    deadline = timezone.now() - timedelta(seconds=timeout)
+    return EncodeJob.objects.filter(status=EncodeJob.RUNNING, started__lt=deadline).update(status=EncodeJob.PENDING, started=None)
+
+
+def run_encode_job(job):
+    src_file_path = os.path.join(ENCODE_JOB_ROOT, job.source)
+    try:
+        with timer('encode.job'), Image.open(src_file_path) as src_image_data:
+            src_image_data.load()
+            download_list = encode_marked_images(src_image_data, job.source_hash, job.variants, Codec(job.format, job.preset))
+    except Exception as e:
+        logging.exception('Encode job failed: %s', job.id)
+        EncodeJob.objects.filter(id=job.id).update(status=EncodeJob.FAILED, error=str(e), finished=timezone.now())
+    else:
+        EncodeJob.objects.filter(id=job.id).update(status=EncodeJob.DONE, result=json.dumps(download_list), finished=timezone.now())
+    finally:
+        if os.path.exists(src_file_path):
+            os.remove(src_file_path)
@@ -1,3 +1,767 @@
-from django.test import TestCase
+import hashlib
+import importlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import clear_url_caches
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from skimage.metrics import structural_similarity
+
+import Mark.urls
+from image import services, views
+from image.models import EncodeJob, MarkedImage
+from utils.luckyen.copyright.similarity.image.cosine import CosineSimilarity
+from utils.luckyen.copyright.similarity.image.feature import FeatureStore, HEADER_SIZE
+from utils.luckyen.copyright.similarity.image.fingerprint import BKTree, FingerprintIndex, distance
+from utils.luckyen.copyright.similarity.video import library
+from utils.luckyen.copyright.similarity.video.frames import describe, normalize
+from utils.luckyen.copyright.watermark.image import payload
+from utils.luckyen.copyright.watermark.image.codec import Codec, FORMATS, PRESETS
+from utils.luckyen.copyright.watermark.image.ssis import SSIS
+from utils.luckyen.copyright.watermark.image.tiled import RawReader, TiledSSIS, writer
+from utils.luckyen.copyright.watermark.video import ffmpeg
+from utils.luckyen.copyright.watermark.video.encode import Encoder
+
+
+def random_image(size, seed):
+    pixels = numpy.random.RandomState(seed).randint(0, 256, (size[1], size[0], 3)).astype(numpy.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+class SSISTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cover = random_image((23, 17), 0)
+
+    def assertSameImage(self, image1, image2):
+        self.assertEqual(image1.size, image2.size)
+        self.assertEqual(image1.mode, image2.mode)
+        self.assertTrue(numpy.array_equal(numpy.asarray(image1), numpy.asarray(image2)))
+
+    def test_merge_same_size(self):
+        secret = random_image(self.cover.size, 1)
+        self.assertSameImage(SSIS.merge(self.cover, secret), SSIS._merge_reference(self.cover, secret))
+
+    def test_merge_smaller_secret(self):
+        secret = random_image((9, 5), 2)
+        self.assertSameImage(SSIS.merge(self.cover, secret), SSIS._merge_reference(self.cover, secret))
+
+    def test_merge_black_and_white_secret(self):
+        pixels = numpy.asarray(random_image((15, 11), 3)).copy()
+        pixels[:4] = 0
+        pixels[4:8] = 255
+        # Black or white in one channel only still carries information
+        pixels[8, :, 0] = 0
+        pixels[9, :, 1] = 255
+        secret = Image.fromarray(pixels, 'RGB')
+        merged = SSIS.merge(self.cover, secret)
+        self.assertSameImage(merged, SSIS._merge_reference(self.cover, secret))
+        # The cover is left unchanged under the black and white pixels
+        self.assertTrue(numpy.array_equal(numpy.asarray(merged)[:8], numpy.asarray(self.cover)[:8]))
+
+    def test_merge_larger_secret(self):
+        with self.assertRaises(ValueError):
+            SSIS.merge(self.cover, random_image((24, 17), 4))
+
+    def test_extract(self):
+        for size in [(23, 17), (9, 5), (1, 1)]:
+            secret = random_image(size, 5)
+            merged = SSIS.merge(Image.new('RGB', self.cover.size), secret)
+            extracted = SSIS.extract(merged)
+            self.assertSameImage(extracted, SSIS._extract_reference(merged))
+            self.assertEqual(extracted.size, size)
+
+    def test_extract_crop(self):
+        # The crop ends at the last valid pixel in column-major order
+        pixels = numpy.zeros((17, 23, 3), dtype=numpy.uint8)
+        pixels[12, 3] = 1
+        pixels[6, 10] = 2
+        image = Image.fromarray(pixels, 'RGB')
+        extracted = SSIS.extract(image)
+        self.assertSameImage(extracted, SSIS._extract_reference(image))
+        self.assertEqual(extracted.size, (11, 7))
+
+    def test_extract_blank(self):
+        image = Image.new('RGB', (23, 17), color=(240, 128, 16))
+        extracted = SSIS.extract(image)
+        self.assertSameImage(extracted, SSIS._extract_reference(image))
+        self.assertEqual(extracted.size, (23, 17))
+
+
+class CosineSimilarityTestCase(SimpleTestCase):
+    # compare_many filters in float64 like structural_similarity, only the order of the sums differs
+    TOLERANCE = 1e-6
+
+    def setUp(self):
+        self.base = numpy.asarray(random_image((40, 30), 10))
+        noise = numpy.random.RandomState(11).randint(-20, 21, self.base.shape)
+        self.quotes = [
+            self.base.copy(),
+            numpy.clip(self.base.astype(int) + noise, 0, 255).astype(numpy.uint8),
+            numpy.asarray(random_image((40, 30), 12)),
+            self.base[::-1].copy(),
+        ]
+
+    def test_structural_similarity(self):
+        scores = CosineSimilarity(self.base).compare_many(self.quotes)
+        self.assertEqual(len(scores), len(self.quotes))
+        for quote, score in zip(self.quotes, scores):
+            expected = structural_similarity(self.base, quote, multichannel=True)
+            self.assertAlmostEqual(score, expected, delta=self.TOLERANCE)
+
+    def test_batches(self):
+        similarity = CosineSimilarity(self.base)
+        self.assertTrue(numpy.allclose(similarity.compare_many(self.quotes, batch_size=3),
+                                       similarity.compare_many(self.quotes), rtol=0, atol=self.TOLERANCE))
+
+    def test_resized(self):
+        # Candidates smaller than the base are compared at their size, as compare does
+        quotes = [numpy.asarray(Image.fromarray(i).resize((32, 24))) for i in self.quotes]
+        similarity = CosineSimilarity(self.base)
+        for multichannel in (True, False):
+            scores = similarity.compare_many(quotes, multichannel)
+            for quote, score in zip(quotes, scores):
+                self.assertAlmostEqual(score, similarity.compare(quote, multichannel), delta=self.TOLERANCE)
+
+    def test_empty(self):
+        self.assertEqual(len(CosineSimilarity(self.base).compare_many([])), 0)
+
+
+class PayloadTestCase(SimpleTestCase):
+    KEY = 'secret key'
+    ID = 8833227139
+
+    def setUp(self):
+        random.seed(0)
+        self.cover = random_image((128, 96), 0)
+        self.marked = SSIS.merge(self.cover, SSIS.secret(self.cover.size), payload.encode(self.ID, self.KEY))
+
+    def reopen(self, image, **options):
+        buffer = io.BytesIO()
+        image.save(buffer, **options)
+        buffer.seek(0)
+        return Image.open(buffer)
+
+    def test_encode_decode(self):
+        for _id in [0, 1, self.ID, (1 << payload.ID_BITS) - 1]:
+            self.assertEqual(payload.decode(payload.encode(_id, self.KEY), self.KEY), _id)
+        with self.assertRaises(ValueError):
+            payload.encode(1 << payload.ID_BITS, self.KEY)
+
+    def test_hamming_correction(self):
+        bits = payload.encode(self.ID, self.KEY)
+        # One error in every codeword is corrected
+        for i in range(0, payload.LENGTH, 7):
+            bits[i + i // 7 % 7] ^= 1
+        self.assertEqual(payload.decode(bits, self.KEY), self.ID)
+
+    def test_png(self):
+        self.assertEqual(SSIS.extract_payload(self.reopen(self.marked, format='PNG'), self.KEY), self.ID)
+
+    def test_jpeg(self):
+        image = self.reopen(self.marked, format='JPEG', quality=100, subsampling=0)
+        self.assertEqual(SSIS.extract_payload(image, self.KEY), self.ID)
+
+    def test_wrong_key(self):
+        self.assertIsNone(SSIS.extract_payload(self.marked, 'another key'))
+
+    def test_unmarked(self):
+        self.assertIsNone(SSIS.extract_payload(self.cover, self.KEY))
+        self.assertIsNone(SSIS.extract_payload(Image.new('RGB', self.cover.size), self.KEY))
+
+    def test_corrupted_block(self):
+        pixels = numpy.asarray(self.marked).copy()
+        # Flip the payload bits of a block, the other repeats of its bits outvote it
+        block = pixels[8:8 + payload.BLOCK, 12:12 + payload.BLOCK]
+        block[...] = (block & 0xF0) | (~block & 0x08) | 0x04
+        self.assertEqual(SSIS.extract_payload(Image.fromarray(pixels, 'RGB'), self.KEY), self.ID)
+
+
+class CodecTestCase(SimpleTestCase):
+    def setUp(self):
+        self.image = random_image((37, 21), 0)
+
+    def save(self, codec):
+        buffer = io.BytesIO()
+        codec.save(self.image, buffer)
+        buffer.seek(0)
+        return buffer
+
+    def test_lossless(self):
+        for f in ('png', 'webp'):
+            for p in PRESETS:
+                image = Image.open(self.save(Codec(f, p)))
+                self.assertTrue(numpy.array_equal(numpy.asarray(image.convert('RGB')), numpy.asarray(self.image)), (f, p))
+
+    def test_jpeg_presets(self):
+        sizes = [len(self.save(Codec('jpeg', p)).getvalue()) for p in PRESETS]
+        self.assertEqual(sorted(sizes, reverse=True), sizes)
+        self.assertEqual(len(set(sizes)), len(PRESETS))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Codec('gif')
+        with self.assertRaises(ValueError):
+            Codec('png', 'fastest')
+        self.assertEqual(Codec('jpeg').extension, FORMATS['jpeg'])
+
+
+class PNGWriterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def round_trip(self, size, rows):
+        pixels = numpy.asarray(random_image(size, size[0] * size[1]))
+        # Flat and gradient areas, so that every filter type is picked somewhere
+        pixels = pixels.copy()
+        pixels[:, :size[0] // 2] = 128
+        pixels[::2, size[0] // 2:] = numpy.arange(size[0] - size[0] // 2, dtype=numpy.uint8)[:, None] * 3
+        file_out = os.path.join(self.path, 'out.png')
+        with writer(file_out, size) as w:
+            for y in range(0, size[1], rows):
+                w.write(pixels[y:y + rows])
+        with Image.open(file_out) as image:
+            self.assertEqual(image.size, size)
+            self.assertTrue(numpy.array_equal(numpy.asarray(image.convert('RGB')), pixels), (size, rows))
+
+    def test_odd_widths(self):
+        for width in (1, 2, 7, 13):
+            self.round_trip((width, 9), 4)
+
+    def test_single_row(self):
+        self.round_trip((17, 1), 1)
+        self.round_trip((17, 1), 8)
+
+    def test_strips(self):
+        # One row per strip, strips not dividing the height, and one strip for the whole image
+        for rows in (1, 3, 5, 100):
+            self.round_trip((19, 16), rows)
+
+
+class BKTreeTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.keys = dict()
+        for i in range(300):
+            # Clusters of close keys, so that there are ties and short distances
+            base = rng.getrandbits(128) if i % 10 == 0 else self.keys['item{}'.format(i - i % 10)]
+            self.keys['item{}'.format(i)] = base ^ (1 << rng.randrange(128)) ^ (1 << rng.randrange(128))
+        self.tree = BKTree()
+        for name, key in self.keys.items():
+            self.tree.add(key, name)
+        for name in list(self.keys)[::7]:
+            self.tree.remove(self.keys.pop(name), name)
+        self.queries = [rng.getrandbits(128) for _ in range(5)] + list(self.keys.values())[:5]
+
+    def brute_force(self, key, radius=None):
+        return sorted((distance(key, v), name) for name, v in self.keys.items() if radius is None or distance(key, v) <= radius)
+
+    def test_nearest(self):
+        for key in self.queries:
+            for k in (1, 5, 30):
+                results = self.tree.nearest(key, k)
+                self.assertEqual([d for d, _ in results], [d for d, _ in self.brute_force(key)[:k]])
+                for d, name in results:
+                    self.assertEqual(distance(key, self.keys[name]), d)
+
+    def test_radius(self):
+        for key in self.queries:
+            for radius in (0, 4, 40):
+                self.assertEqual(self.tree.nearest(key, len(self.keys), radius), self.brute_force(key, radius))
+                results = self.tree.nearest(key, 3, radius)
+                self.assertEqual([d for d, _ in results], [d for d, _ in self.brute_force(key, radius)[:3]])
+
+    def test_removed(self):
+        removed = BKTree()
+        removed.add(1, 'a')
+        removed.add(3, 'b')
+        removed.remove(1, 'a')
+        self.assertEqual(removed.nearest(1, 5), [(1, 'b')])
+        self.assertEqual(removed.nearest(1, 0), [])
+
+
+class FingerprintIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, 'fingerprint.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def lines(self):
+        with io.open(self.file, 'r', encoding='utf8') as f:
+            return f.read().splitlines()
+
+    def test_round_trip(self):
+        index = FingerprintIndex(self.file)
+        other = FingerprintIndex(self.file)
+        index.add_many([('a', 0b0000), ('b', 0b0011), ('c', 0b1111)])
+        index.remove('b')
+        index.add('c', key=0b0111)
+        # Another process replays the log
+        self.assertEqual(len(other), 2)
+        self.assertNotIn('b', other)
+        self.assertEqual(other.search(0b0110, k=5), [(1, 'c'), (2, 'a')])
+        self.assertEqual(len(self.lines()), 5)
+        # Compaction keeps the live entries only, the other process reloads the new log
+        self.assertEqual(index.compact(exists=lambda name: name != 'a'), 1)
+        self.assertEqual(len(self.lines()), 1)
+        self.assertEqual(other.search(0b0110, k=5), [(1, 'c')])
+        other.add('d', key=0b0110)
+        self.assertEqual(index.search(0b0110, k=5), [(0, 'd'), (1, 'c')])
+        self.assertEqual(FingerprintIndex(self.file).search(0b0110, k=5), [(0, 'd'), (1, 'c')])
+
+    def test_partial_line(self):
+        index = FingerprintIndex(self.file)
+        index.add('a', key=1)
+        # A record still being written by another process is read once complete
+        with io.open(self.file, 'ab') as f:
+            f.write(b'{"op": "add", "name": "b", ')
+        self.assertEqual(len(index), 1)
+        with io.open(self.file, 'ab') as f:
+            f.write(b'"hash": "3"}\n')
+        self.assertEqual(index.search(3, k=5), [(0, 'b'), (1, 'a')])
+
+
+class FeatureStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, 'features.arena')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_round_trip(self):
+        store = FeatureStore(self.file, (8, 6))
+        other = FeatureStore(self.file, (8, 6))
+        features = [numpy.asarray(random_image((8, 6), i)) for i in range(3)]
+        store.add_many([('a', features[0]), ('b', features[1])])
+        other.add('c', features[2])
+        for name, feature in zip('abc', features):
+            self.assertTrue(numpy.array_equal(store.get(name), feature))
+            self.assertTrue(numpy.array_equal(other.get(name), feature))
+        self.assertIsNone(store.get('d'))
+        self.assertEqual(len(FeatureStore(self.file, (8, 6))), 3)
+        with self.assertRaises(ValueError):
+            FeatureStore(self.file, (16, 12))
+
+    def test_first_writers(self):
+        # Both files are opened before either writer appends, only the first one writes the header
+        stores = [FeatureStore(self.file, (8, 6)) for _ in range(2)]
+        handles = [io.open(self.file, 'ab') for _ in range(2)]
+        real_open = io.open
+
+        def open_file(path, mode='r', *args, **kwargs):
+            return handles.pop(0) if mode == 'ab' else real_open(path, mode, *args, **kwargs)
+
+        try:
+            with mock.patch('utils.luckyen.copyright.similarity.image.feature.io.open', side_effect=open_file):
+                stores[0].add('a', numpy.asarray(random_image((8, 6), 0)))
+                stores[1].add('b', numpy.asarray(random_image((8, 6), 1)))
+        finally:
+            for f in handles:
+                f.close()
+        self.assertEqual((os.path.getsize(self.file) - HEADER_SIZE) % stores[0].dtype.itemsize, 0)
+        self.assertEqual(len(FeatureStore(self.file, (8, 6))), 2)
+
+
+class CreateMarkedImagesTestCase(TestCase):
+    def setUp(self):
+        self.image = random_image((32, 24), 20)
+        services.create_marked_images(self.image, 'taken', 1, 'png')
+        self.taken = MarkedImage.objects.get().id
+
+    def create(self, *ids):
+        with mock.patch.object(services, 'create_random_str', side_effect=list(ids)) as create_random_str:
+            records = services.create_marked_images(self.image, 'source', 2, 'png')
+        return records, create_random_str.call_count
+
+    def test_collision(self):
+        records, calls = self.create(self.taken, '0000000002', '0000000003', '0000000004')
+        self.assertEqual(calls, 4)
+        self.assertEqual([i.id for i in records], ['0000000003', '0000000004'])
+        # The insert of the colliding IDs was rolled back as a whole
+        self.assertFalse(MarkedImage.objects.filter(id='0000000002').exists())
+        self.assertEqual(MarkedImage.objects.get(id=self.taken).source_hash, 'taken')
+        self.assertEqual(MarkedImage.objects.filter(source_hash='source').count(), 2)
+
+    def test_duplicate_draw(self):
+        records, calls = self.create('0000000005', '0000000005', '0000000006', '0000000007')
+        self.assertEqual(calls, 4)
+        self.assertEqual([i.variant for i in records], [0, 1])
+        self.assertEqual(sorted(MarkedImage.objects.filter(source_hash='source').values_list('id', flat=True)),
+                         ['0000000006', '0000000007'])
+
+    def test_failure(self):
+        # Errors other than a collision are not retried and leave nothing behind
+        with mock.patch.object(MarkedImage.objects, 'bulk_create', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                services.create_marked_images(self.image, 'source', 2, 'png')
+        self.assertFalse(MarkedImage.objects.filter(source_hash='source').exists())
+
+
+class EncodeJobTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patches = [mock.patch.object(views, 'ENCODE_JOB_ROOT', self.root), mock.patch.object(services, 'ENCODE_JOB_ROOT', self.root)]
+        for i in patches:
+            i.start()
+            self.addCleanup(i.stop)
+        self.client = APIClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def post(self, content):
+        return self.client.post('/image/encode/', {'src_image': SimpleUploadedFile('src.jpg', content), 'async': 'true'}, format='multipart')
+
+    def submit(self):
+        f = io.BytesIO()
+        random_image((32, 24), 30).save(f, 'JPEG')
+        with mock.patch.object(views, 'timer', wraps=views.timer) as timer:
+            response = self.post(f.getvalue())
+        self.assertEqual(response.status_code, 202)
+        # The upload is hashed while it is copied, in one pass
+        self.assertEqual([i[0][0] for i in timer.call_args_list].count('encode.upload'), 1)
+        job = EncodeJob.objects.get(id=response.data['data']['job'])
+        self.assertEqual(job.source_hash, hashlib.sha256(f.getvalue()).hexdigest())
+        return job
+
+    def test_invalid_upload(self):
+        f = io.BytesIO()
+        random_image((32, 24), 31).save(f, 'PNG')
+        # A PNG cut in the middle of its data fails the checksums
+        for content in (b'not an image', f.getvalue()[:-30]):
+            with self.assertLogs('django.request', 'WARNING'):
+                response = self.post(content)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(EncodeJob.objects.exists())
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_done(self):
+        job = self.submit()
+        self.assertEqual(job.status, EncodeJob.PENDING)
+        self.assertTrue(os.path.exists(os.path.join(self.root, job.source)))
+        claimed = services.claim_encode_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, EncodeJob.RUNNING)
+        self.assertIsNotNone(claimed.started)
+        # Claimed once only
+        self.assertIsNone(services.claim_encode_job())
+        urls = ['http://host/media/c/00/{}.png'.format(i) for i in range(3)]
+        with mock.patch.object(services, 'encode_marked_images', return_value=urls) as encode:
+            services.run_encode_job(claimed)
+        self.assertEqual(encode.call_args[0][1], job.source_hash)
+        self.assertEqual(encode.call_args[0][0].size, (32, 24))
+        response = self.client.get('/image/encode/{}/'.format(job.id))
+        self.assertEqual(response.data['data']['status'], EncodeJob.DONE)
+        self.assertEqual([i['download'] for i in response.data['data']['downloadlist']], urls)
+        self.assertFalse(os.path.exists(os.path.join(self.root, job.source)))
+
+    def test_failed(self):
+        job = self.submit()
+        with mock.patch.object(services, 'encode_marked_images', side_effect=OSError('disk full')), self.assertLogs(level='ERROR'):
+            services.run_encode_job(services.claim_encode_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, EncodeJob.FAILED)
+        self.assertEqual(job.error, 'disk full')
+        self.assertIsNotNone(job.finished)
+        self.assertFalse(os.path.exists(os.path.join(self.root, job.source)))
+
+    def test_requeue_stale(self):
+        stale = self.submit()
+        recent = self.submit()
+        services.claim_encode_job()
+        services.claim_encode_job()
+        EncodeJob.objects.filter(id=stale.id).update(started=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(services.requeue_stale_encode_jobs(60), 1)
+        self.assertEqual(EncodeJob.objects.get(id=recent.id).status, EncodeJob.RUNNING)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, EncodeJob.PENDING)
+        self.assertIsNone(stale.started)
+        self.assertEqual(services.claim_encode_job().id, stale.id)
+
+
+class VideoSearchTestCase(SimpleTestCase):
+    def post(self, k):
+        f = io.BytesIO()
+        random_image((32, 24), 40).save(f, 'PNG')
+        data = {'image': SimpleUploadedFile('frame.png', f.getvalue()), 'k': k}
+        return APIClient().post('/image/video/search/', data, format='multipart')
+
+    def test_k(self):
+        with mock.patch.object(views.video_library, 'search', return_value=[('video.mp4', 3, 1.0, 0)]) as search:
+            self.assertEqual(self.post(5).status_code, 200)
+            self.assertEqual(search.call_args[0][1], 5)
+            self.assertEqual(self.post(10 ** 9).status_code, 200)
+            self.assertEqual(search.call_args[0][1], views.VIDEO_SEARCH_MAX_K)
+            with self.assertLogs('django.request', 'WARNING'):
+                for k in (0, -1, 'a'):
+                    self.assertEqual(self.post(k).status_code, 400)
+        self.assertEqual(search.call_count, 2)
+
+
+class VideoLibraryTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # Every video is a few random frames, fingerprinted as FrameFingerprints would
+        self.frames = {'video{}.mp4'.format(i): [random_image((32, 24), 100 + 10 * i + j) for j in range(4 + i)] for i in range(4)}
+        patch = mock.patch.object(library, 'FrameFingerprints', side_effect=self.fingerprints)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def fingerprints(self, file_in, show_progress=False):
+        described = [describe(normalize(i)) for i in self.frames[file_in]]
+        hashes = numpy.array([[key >> 64, key & library.MASK] for key, _ in described], dtype=numpy.uint64)
+        return mock.Mock(hashes=hashes, thumbnails=numpy.array([i for _, i in described]), __len__=lambda _: len(described))
+
+    def assertSameSearches(self, videos):
+        fresh = library.VideoLibrary(self.path)
+        for frames in self.frames.values():
+            for image in frames[:2]:
+                self.assertEqual(sorted(videos.search(image, 3)), sorted(fresh.search(image, 3)))
+        index = videos.build()
+        self.assertEqual(sorted(index['ids']), sorted(fresh.videos))
+        for b in range(library.BANDS):
+            self.assertTrue(numpy.array_equal(index['keys'][:, b], library.bands(index['hashes'])[index['order'][:, b], b]))
+            self.assertTrue(numpy.all(numpy.diff(index['keys'][:, b].astype(int)) >= 0))
+
+    def test_incremental(self):
+        videos = library.VideoLibrary(self.path)
+        self.assertEqual(videos.search(self.frames['video0.mp4'][0], 3), [])
+        videos.add('video0.mp4')
+        videos.add('video1.mp4')
+        self.assertSameSearches(videos)
+        with mock.patch.object(library.numpy, 'load', wraps=numpy.load) as load:
+            videos.add('video2.mp4')
+            videos.add('video3.mp4')
+            self.assertSameSearches(videos)
+        # The fresh libraries load the 4 videos, the updated one only the 2 new ones
+        self.assertEqual(load.call_count, 2 + 4)
+        hits = videos.search(self.frames['video2.mp4'][1], 1)
+        self.assertEqual(hits[0][:2], ('video2.mp4', 1))
+        videos.remove('video2.mp4')
+        self.assertSameSearches(videos)
+        self.assertNotIn('video2.mp4', [i[0] for i in videos.search(self.frames['video2.mp4'][1], 20)])
+        # Updated videos replace their frames
+        self.frames['video1.mp4'] = self.frames['video1.mp4'][::-1]
+        videos.add('video1.mp4')
+        self.assertSameSearches(videos)
+        self.assertEqual(videos.search(self.frames['video1.mp4'][0], 1)[0][:2], ('video1.mp4', 0))
+
+    def test_compaction(self):
+        videos = library.VideoLibrary(self.path)
+        for name in self.frames:
+            videos.add(name)
+        videos.build()
+        for name in ['video1.mp4', 'video2.mp4', 'video3.mp4']:
+            videos.remove(name)
+        index = videos.build()
+        # Most frames were removed, the index only holds the ones left
+        self.assertEqual(index['names'], ['video0.mp4'])
+        self.assertTrue(index['live'].all())
+        self.assertSameSearches(videos)
+
+
+class EncoderTestCase(SimpleTestCase):
+    def setUp(self):
+        # Only what transcode needs, without a video to read
+        self.encoder = Encoder.__new__(Encoder)
+        self.encoder.shape = (24, 32, 3)
+        self.encoder.ciphers = [['1'], ['2']]
+        self.encoder.positions = [3]
+        self.encoder.locations = [[(5, 5)]]
+        self.video = mock.Mock(get_data=lambda i: numpy.zeros(self.encoder.shape, dtype=numpy.uint8))
+
+    def transcode(self):
+        errors = []
+
+        def run():
+            try:
+                self.encoder.transcode(self.video, 20, 0, ['0.mp4', '1.mp4'], 25, False, queue_size=1)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), 'transcode is blocked')
+        return errors
+
+    def test_writer_fails_to_start(self):
+        with mock.patch('imageio.get_writer', side_effect=OSError('no ffmpeg')), self.assertLogs(level='ERROR'):
+            errors = self.transcode()
+        self.assertEqual([str(i) for i in errors], ['no ffmpeg'])
+
+    def test_writer_fails_to_close(self):
+        writer = mock.Mock(close=mock.Mock(side_effect=OSError('disk full')))
+        with mock.patch('imageio.get_writer', return_value=writer), mock.patch.object(Encoder, 'encode', side_effect=lambda image, *_: image), \
+                self.assertLogs(level='ERROR'):
+            errors = self.transcode()
+        self.assertEqual([str(i) for i in errors], ['disk full'])
+        # Both copies share the mocked writer
+        self.assertEqual(writer.append_data.call_count, 2 * 20)
+
+    def test_smart_needs_h264(self):
+        source = {'codec': 'mpeg4', 'profile': 'Simple Profile', 'pix_fmt': 'yuv420p', 'width': 32, 'height': 24}
+        self.encoder.file = 'video.mp4'
+        with mock.patch.object(ffmpeg, 'probe', return_value=source), mock.patch.object(ffmpeg, 'segment') as segment, \
+                mock.patch.object(Encoder, 'run') as run, self.assertLogs(level='WARNING'):
+            self.encoder.smart(False, 4)
+        run.assert_called_once_with(False, 4)
+        segment.assert_not_called()
+
+
+class FFmpegTestCase(SimpleTestCase):
+    LOG = (
+        "Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'video.mp4':\n"
+        "  Stream #0:0[0x1](und): Video: {} (avc1 / 0x31637661), yuv420p(tv, bt709, progressive), 160x120 [SAR 1:1 DAR 4:3], "
+        "38 kb/s, 25 fps, 25 tbr, 12800 tbn (default)\n"
+        "Stream mapping:\n"
+        "  Stream #0:0 -> #0:0 (h264 (native) -> wrapped_avframe (native))\n"
+        "  Stream #0:0(und): Video: wrapped_avframe, yuv444p, 320x240, q=2-31, 200 kb/s, 25 fps, 25 tbn (default)\n"
+    )
+
+    def test_probe(self):
+        with mock.patch.object(ffmpeg, 'run', return_value=self.LOG.format('h264 (High)')):
+            self.assertEqual(ffmpeg.probe('video.mp4'), {'codec': 'h264', 'profile': 'High', 'pix_fmt': 'yuv420p', 'width': 160, 'height': 120})
+        with mock.patch.object(ffmpeg, 'run', return_value=self.LOG.format('h264 (Constrained Baseline)')):
+            self.assertEqual(ffmpeg.PROFILES[ffmpeg.probe('video.mp4')['profile'].lower()], 'baseline')
+
+    def test_probe_no_video(self):
+        with mock.patch.object(ffmpeg, 'run', return_value="Input #0, wav, from 'audio.wav':\n  Stream #0:0: Audio: pcm_s16le\n"):
+            with self.assertRaises(RuntimeError):
+                ffmpeg.probe('audio.wav')
+
+
+class TiledSSISTestCase(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file_in = os.path.join(self.path, 'cover.ppm')
+        self.cover = random_image((320, 200), 50)
+        self.cover.save(self.file_in)
+        random.seed(0)
+        self.layout = SSIS.layout(self.cover.size)
+        self.secret = SSIS.draw(Image.new('RGB', self.cover.size, color=(255, 255, 255)), self.layout, SSIS.font(self.cover.size))
+        self.payload = payload.encode(PayloadTestCase.ID, PayloadTestCase.KEY)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def merge(self, extension, payload_bits):
+        file_out = os.path.join(self.path, 'marked' + extension)
+        # Strips of 16 rows, the characters cross them
+        tiled = TiledSSIS(self.file_in, self.cover.size[0] * 16)
+        try:
+            tiled.merge(file_out, layout=self.layout, payload=payload_bits)
+        finally:
+            tiled.close()
+        return file_out
+
+    def test_merge(self):
+        for payload_bits in (None, self.payload):
+            expected = SSIS.merge(self.cover, self.secret, payload_bits)
+            file_out = self.merge('.ppm', payload_bits)
+            f = io.BytesIO()
+            expected.save(f, 'PPM')
+            with open(file_out, 'rb') as g:
+                self.assertEqual(g.read(), f.getvalue())
+            # The PNG encoders differ, not the pixels
+            with Image.open(self.merge('.png', payload_bits)) as image:
+                self.assertEqual((image.mode, image.size), (expected.mode, expected.size))
+                self.assertEqual(image.tobytes(), expected.tobytes())
+
+    def test_large_image(self):
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            with self.assertRaises(Image.DecompressionBombError):
+                Image.open(self.file_in)
+            reader = RawReader(self.file_in)
+            try:
+                self.assertEqual(reader.size, self.cover.size)
+                self.assertEqual(reader.read(0, 200).tobytes(), self.cover.tobytes())
+            finally:
+                reader.close()
+            # The limit of the other threads is left as is
+            self.assertEqual(Image.MAX_IMAGE_PIXELS, 1000)
+
+
+@override_settings(MEDIA_SERVE=True)
+class MediaViewTestCase(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reload_urls()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.reload_urls()
+
+    @staticmethod
+    def reload_urls():
+        # /media/ is only routed when MEDIA_SERVE is set as the URLs are loaded
+        importlib.reload(Mark.urls)
+        clear_url_caches()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patch = mock.patch.object(views, 'MEDIA_ROOT', self.root)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.digest = hashlib.sha256(b'marked').hexdigest()
+        self.path = 'c/{}/{}.png'.format(self.digest[:2], self.digest)
+        os.makedirs(os.path.join(self.root, os.path.dirname(self.path)))
+        for name in (self.path, 'marked_0000000001.png'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(b'marked')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def get(self, path, **headers):
+        response = self.client.get('/media/' + path, **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def assertCached(self, response):
+        self.assertEqual(response['ETag'], '"{}"'.format(self.digest))
+        self.assertEqual(sorted(response['Cache-Control'].split(', ')), ['immutable', 'max-age={}'.format(views.MEDIA_CACHE_SECONDS), 'public'])
+
+    def test_content(self):
+        response = self.get(self.path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'marked')
+        self.assertCached(response)
+
+    def test_not_modified(self):
+        response = self.get(self.path, HTTP_IF_NONE_MATCH='"other", "{}"'.format(self.digest))
+        self.assertEqual(response.status_code, 304)
+        self.assertCached(response)
+        self.assertEqual(self.get(self.path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_other_files(self):
+        # Files named after their ID may be replaced, they are not cached as immutable
+        response = self.get('marked_0000000001.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.get('Cache-Control', ''))
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.get('c/00/missing.png').status_code, 404)
+
+    def test_media_url(self):
+        with mock.patch.object(services, 'MEDIA_HOST', 'http://nginx'):
+            self.assertEqual(services.media_url(self.path), 'http://nginx/media/' + self.path)
@@ -4,4 +4,6 @@ from . import views
 urlpatterns = [
     path('decode/', views.DecodeAPIView.as_view(), name='decode'),
     path('encode/', views.EncodeAPIView.as_view(), name='encode'),
+    path('encode/<str:job_id>/', views.EncodeJobAPIView.as_view(), name='encode_job'),
+    path('video/search/', views.VideoSearchAPIView.as_view(), name='video_search'),
 ]
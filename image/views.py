@@ -1,42 +1,34 @@
-import random
-import string
-from copy import deepcopy
+import hashlib
+import json
 import os
-import operator
+import time
+import uuid
 
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from django.views.static import serve
 from PIL import Image
 
 from rest_framework.response import Response
 from rest_framework import views
 from rest_framework import status
 
-from Mark.settings import MEDIA_ROOT, MEDIA_URL, HOST
+from Mark.settings import FEATURE_SIZE, DECODE_COARSE, DECODE_FINE, DECODE_TOP_K, ENCODE_ASYNC, ENCODE_JOB_ROOT, VIDEO_SEARCH_TOP_K, \
+    VIDEO_SEARCH_MAX_K, ENCODE_FORMAT, ENCODE_PRESET, MEDIA_ROOT, MEDIA_CONTENT_DIR, MEDIA_CACHE_SECONDS
 
-from utils.luckyen.copyright.watermark.image.ssis import SSIS
-from utils.luckyen.copyright.similarity.image.entropy import EntropySimilarity
+from image.models import EncodeJob
+from image.services import scorer, video_library, get_candidate_marked_image, get_marked_image_by_payload, load_feature, \
+    encode_marked_images
+from utils.luckyen.copyright.metrics import timer
+from utils.luckyen.copyright.similarity.image.feature import feature
+from utils.luckyen.copyright.similarity.image.ranking import TwoStageRanker, COARSE, FINE
+from utils.luckyen.copyright.watermark.image.codec import Codec
 
 
 # Create your views here.
 
 
-def create_random_str(num=10):
-    return ''.join(random.choice(string.digits) for _ in range(num))
-
-
-def get_max_score(score_dict):
-    score_dict = sorted(score_dict.items(), key=operator.itemgetter(1))[0]
-    return score_dict
-
-
-def get_all_marked_image_name(path=MEDIA_ROOT):
-    names = os.listdir(path)
-    for name in names:
-        if 'marked' not in name:
-            names.remove(name)
-    names = ['{path}{name}'.format(path=path, name=name) for name in names]
-    return names
-
-
 class EncodeAPIView(views.APIView):
 
     def post(self, request, *args, **kwargs):
@@ -44,30 +36,75 @@ class EncodeAPIView(views.APIView):
         if request.data.get('src_image') is None:
             return Response({"code":1, "msg":'src_image字段不能为空'},status=status.HTTP_400_BAD_REQUEST)
         image_file = request.data.get('src_image')
-        random_str = create_random_str()
-        src_file_path = '{media_root}src_{id}.jpg'.format(media_root=MEDIA_ROOT, id=random_str)
-        with open(src_file_path, 'wb') as f:
+        try:
+            codec = Codec(request.data.get('format', ENCODE_FORMAT), request.data.get('preset', ENCODE_PRESET))
+        except ValueError as e:
+            return Response({"code": 1, "msg": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        source_hash = hashlib.sha256()
+
+        if str(request.data.get('async', ENCODE_ASYNC)).lower() in ('1', 'true'):
+            try:
+                with timer('encode.open'):
+                    image_file.seek(0)
+                    # Checks the file without decoding it, the worker decodes it
+                    Image.open(image_file).verify()
+            except (OSError, SyntaxError):
+                return Response({"code": 1, "msg": 'src_image不是有效的图片'}, status=status.HTTP_400_BAD_REQUEST)
+            # The worker needs a copy of the upload, it removes it once the job is over
+            job_id = uuid.uuid4().hex
+            src_file_name = '{id}.jpg'.format(id=job_id)
+            with timer('encode.upload'), open(os.path.join(ENCODE_JOB_ROOT, src_file_name), 'wb') as f:
+                for chunk in image_file.chunks():
+                    source_hash.update(chunk)
+                    f.write(chunk)
+            job = EncodeJob.objects.create(
+                id=job_id,
+                source=src_file_name,
+                source_hash=source_hash.hexdigest(),
+                format=codec.format,
+                preset=codec.preset
+            )
+            data = {"code": 0,
+                    "msg": "成功",
+                    "data": {"job": job.id, "status": job.status, "format": job.format}
+                    }
+            return Response(data=data, status=status.HTTP_202_ACCEPTED)
+
+        with timer('encode.upload'):
             for chunk in image_file.chunks():
-                f.write(chunk)
-        file_path_list = list()
-        download_list = list()
-        for i in range(3):
-            file_name = 'marked_{id}.jpg'.format(id=create_random_str())
-            file_path_list.append('{media_root}{file_name}'.format(media_root=MEDIA_ROOT, file_name=file_name))
-            download_list.append(
-                '{host}{media_url}{file_name}'.format(host=HOST, media_url=MEDIA_URL, file_name=file_name))
-        src_image_data = Image.open(src_file_path)
-        ssis = SSIS()
-        for file_path in file_path_list:
-            mark_image = ssis.secret(src_image_data.size)
-            ssis.merge(deepcopy(src_image_data), mark_image).save(file_path, format='JPEG', subsampling=0, quality=100)
-
+                source_hash.update(chunk)
+        try:
+            with timer('encode.open'):
+                image_file.seek(0)
+                src_image_data = Image.open(image_file)
+                src_image_data.load()
+        except OSError:
+            return Response({"code": 1, "msg": 'src_image不是有效的图片'}, status=status.HTTP_400_BAD_REQUEST)
+        download_list = encode_marked_images(src_image_data, source_hash.hexdigest(), codec=codec)
         download_dict = [{"download": item} for item in download_list]
 
         data = {"code": 0,
                 "msg": "成功",
-                "data": {"downloadlist": download_dict}
+                "data": {"downloadlist": download_dict, "format": codec.format}
+                }
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
+class EncodeJobAPIView(views.APIView):
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = EncodeJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({"code": 1, "msg": '任务不存在'}, status=status.HTTP_404_NOT_FOUND)
+        data = {"code": 0,
+                "msg": "成功",
+                "data": {"job": job.id, "status": job.status, "format": job.format}
                 }
+        if job.status == EncodeJob.DONE:
+            data["data"]["downloadlist"] = [{"download": item} for item in json.loads(job.result)]
+        elif job.status == EncodeJob.FAILED:
+            data["code"] = 1
+            data["msg"] = job.error
         return Response(data=data, status=status.HTTP_200_OK)
 
 
@@ -77,25 +114,111 @@ class DecodeAPIView(views.APIView):
         if request.data.get('marked_image') is None:
             return Response({"code":1, "msg":'marked_image字段不能为空'},status=status.HTTP_400_BAD_REQUEST)
         file = request.data.get('marked_image')
-        file_path = '{media_root}temp.jpg'.format(media_root=MEDIA_ROOT)
-        with open(file_path, 'wb') as f:
-            for chunk in file.chunks():
-                f.write(chunk)
-        names = get_all_marked_image_name(path=MEDIA_ROOT)
-        score_dict = dict()
-        for name in names:
-            score = EntropySimilarity(file_path).compare(name)
-            score_dict.__setitem__(name, score)
-        _id, score = get_max_score(score_dict)
-        id = str(_id).split('_')[-1].split('.')[0]
+        try:
+            with timer('decode.open'):
+                image = Image.open(file)
+                image.load()
+        except OSError:
+            return Response({"code": 1, "msg": 'marked_image不是有效的图片'}, status=status.HTTP_400_BAD_REQUEST)
+        t = time.perf_counter()
+        with timer('decode.payload'):
+            record = get_marked_image_by_payload(image)
+        if record is not None:
+            data = {"code": 0,
+                    "msg": "成功",
+                    "data": {
+                        "id": record.id,
+                        "score": "1.0",
+                        "method": "payload",
+                        "timings": {"payload": (time.perf_counter() - t) * 1000}
+                    }
+                    }
+            return Response(data=data, status=status.HTTP_200_OK)
+        # Without a valid payload, e.g. the image was resized, fall back to the similarity search
+        coarse = request.data.get('coarse', DECODE_COARSE)
+        if coarse not in COARSE:
+            return Response({"code": 1, "msg": 'coarse必须是{}之一'.format(', '.join(COARSE))}, status=status.HTTP_400_BAD_REQUEST)
+        fine = request.data.get('fine', DECODE_FINE)
+        if fine not in FINE:
+            return Response({"code": 1, "msg": 'fine必须是{}之一'.format(', '.join(FINE))}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            k = int(request.data.get('k', DECODE_TOP_K))
+        except ValueError:
+            return Response({"code": 1, "msg": 'k必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+        if k < 1:
+            return Response({"code": 1, "msg": 'k必须是正整数'}, status=status.HTTP_400_BAD_REQUEST)
+        with timer('decode.feature'):
+            query = feature(image, FEATURE_SIZE)
+        ranker = TwoStageRanker(query, coarse=coarse, fine=fine, k=k, scorer=scorer)
+        with timer('decode.candidates'):
+            candidates, records = get_candidate_marked_image(image)
+        if not candidates:
+            return Response({"code": 1, "msg": '没有找到相似的图片'}, status=status.HTTP_404_NOT_FOUND)
+        ranking = ranker.rank(candidates, load_feature)
+        name, score = ranking['best']
 
         data = {"code": 0,
                 "msg": "成功",
                 "data": {
-                    "id": id,
-                    "score": str(score)
+                    "id": records[name].id,
+                    "score": str(score),
+                    "method": "similarity",
+                    "ranking": {
+                        "coarse": [{"id": records[i].id, "score": j} for i, j in ranking['coarse']],
+                        "fine": [{"id": records[i].id, "score": j} for i, j in ranking['fine']],
+                        "timings": ranking['timings']
+                    }
                 }
                 }
-        if os.path.exists(file_path):
-            os.remove(file_path)
         return Response(data=data, status=status.HTTP_200_OK)
+
+
+class VideoSearchAPIView(views.APIView):
+
+    def post(self, request, *args, **kwargs):
+        if request.data.get('image') is None:
+            return Response({"code": 1, "msg": 'image字段不能为空'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with timer('video.open'):
+                image = Image.open(request.data.get('image'))
+                image.load()
+        except OSError:
+            return Response({"code": 1, "msg": 'image不是有效的图片'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            k = int(request.data.get('k', VIDEO_SEARCH_TOP_K))
+        except ValueError:
+            return Response({"code": 1, "msg": 'k必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+        if k < 1:
+            return Response({"code": 1, "msg": 'k必须是正整数'}, status=status.HTTP_400_BAD_REQUEST)
+        k = min(k, VIDEO_SEARCH_MAX_K)
+        t = time.perf_counter()
+        with timer('video.search'):
+            hits = video_library.search(image, k)
+        if not hits:
+            return Response({"code": 1, "msg": '视频库为空'}, status=status.HTTP_404_NOT_FOUND)
+
+        data = {"code": 0,
+                "msg": "成功",
+                "data": {
+                    "hits": [{"video": name, "frame": frame, "score": score, "distance": d} for name, frame, score, d in hits],
+                    "timings": {"search": (time.perf_counter() - t) * 1000}
+                }
+                }
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
+def media_view(request, path):
+    """
+    Serve MEDIA_ROOT when there is no nginx in front of the service (MEDIA_SERVE), with the same cache headers
+    and ETags as nginx for the content addressed files
+    """
+    if not path.startswith(MEDIA_CONTENT_DIR + '/'):
+        return serve(request, path, document_root=MEDIA_ROOT)
+    etag = '"{}"'.format(os.path.splitext(os.path.basename(path))[0])
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = serve(request, path, document_root=MEDIA_ROOT)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=MEDIA_CACHE_SECONDS, immutable=True)
+    return response
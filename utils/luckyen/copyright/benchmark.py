@@ -0,0 +1,264 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import imageio
+import numpy
+from PIL import Image, ImageDraw
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.similarity.image.cosine import CosineSimilarity
+from utils.luckyen.copyright.similarity.image.diff import DiffSimilarity
+from utils.luckyen.copyright.similarity.image.entropy import EntropySimilarity
+from utils.luckyen.copyright.watermark.image.ssis import SSIS, FONTS_PATH
+from utils.luckyen.copyright.watermark.video.assemble import Assembler, Shard
+from utils.luckyen.copyright.watermark.video.decode import Decoder
+from utils.luckyen.copyright.watermark.video.encode import Encoder, init_ciphers
+from utils.luckyen.copyright.watermark.video.split import Splitter
+
+GROUPS = ('image', 'similarity', 'video')
+
+
+def synthetic_image(size, seed=0):
+    """
+    Gradients, shapes and noise, so that codecs and similarity measures do not meet a flat image
+    :param size: (width, height)
+    """
+    rng = numpy.random.RandomState(seed)
+    w, h = size
+    x, y = numpy.meshgrid(numpy.linspace(0, 1, w), numpy.linspace(0, 1, h))
+    pixels = numpy.stack([x * 255, y * 255, (1 - x) * y * 255], axis=2) + rng.normal(0, 12, (h, w, 3))
+    image = Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8), 'RGB')
+    d = ImageDraw.Draw(image)
+    for _ in range(24):
+        x0, y0 = rng.randint(0, w), rng.randint(0, h)
+        d.ellipse((x0, y0, x0 + rng.randint(8, w // 4 + 9), y0 + rng.randint(8, h // 4 + 9)), fill=tuple(int(i) for i in rng.randint(0, 256, 3)))
+    return image
+
+
+def synthetic_video(file_out, size, frames, fps=25, seed=0):
+    """
+    A synthetic image moving across the frames, encoded with the default imageio settings
+    """
+    base = numpy.asarray(synthetic_image((size[0] * 2, size[1]), seed))
+    writer = imageio.get_writer(file_out, fps=fps, macro_block_size=1)
+    try:
+        for i in range(frames):
+            offset = i * size[0] // max(frames, 1)
+            writer.append_data(base[:, offset:offset + size[0]])
+    finally:
+        writer.close()
+    return file_out
+
+
+def measure(fn, repeat=3, setup=None):
+    """
+    Run fn repeat times, setup is run before every run and is not timed
+    :return: a dict of the median and the best time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return {'seconds': statistics.median(times), 'best': min(times)}
+
+
+def parse_size(s):
+    w, h = s.lower().split('x')
+    return int(w), int(h)
+
+
+class Benchmark:
+    """
+    Time the watermark and similarity kernels on synthetic inputs.
+    Image kernels report megapixels per second, video ones frames per second.
+    """
+
+    def __init__(self, sizes=((640, 480), (1280, 720)), video_sizes=((320, 240), (640, 360)), frames=60, repeat=3, groups=GROUPS):
+        self.sizes = [tuple(i) for i in sizes]
+        self.video_sizes = [tuple(i) for i in video_sizes]
+        self.frames = frames
+        self.repeat = repeat
+        self.groups = groups
+        self.results = dict()
+        logging.info('Benchmark is successfully initialized.')
+
+    def record(self, name, timing, **throughput):
+        for k, v in list(throughput.items()):
+            throughput[k] = v / timing['seconds'] if timing['seconds'] else None
+        self.results[name] = dict(timing, **throughput)
+        logging.info('%s: %.2f ms %s', name, timing['seconds'] * 1000, ' '.join('{} {:.2f}'.format(k, v) for k, v in throughput.items() if v))
+
+    def image(self):
+        for size in self.sizes:
+            mp = size[0] * size[1] / 1e6
+            tag = '{}x{}'.format(*size)
+            source = synthetic_image(size)
+            random.seed(0)
+            secret = SSIS.secret(size, FONTS_PATH)
+            marked = SSIS.merge(source, secret)
+            self.record('ssis.secret/{}'.format(tag), measure(lambda: SSIS.secret(size, FONTS_PATH), self.repeat), mp_per_s=mp)
+            self.record('ssis.merge/{}'.format(tag), measure(lambda: SSIS.merge(source, secret), self.repeat), mp_per_s=mp)
+            self.record('ssis.extract/{}'.format(tag), measure(lambda: SSIS.extract(marked), self.repeat), mp_per_s=mp)
+
+    def pyramid(self, name, similarity, f_quote, tag, mp):
+        """
+        Latency of every level of compare_pyramid and the error of its score against the full resolution one
+        """
+        reports = [similarity.compare_pyramid(f_quote, ambiguous=None)[1] for _ in range(self.repeat)]
+        full = reports[0][-1]['score']
+        for i, level in enumerate(reports[0]):
+            times = [report[i]['ms'] / 1000 for report in reports]
+            key = '{}.pyramid.{}x{}/{}'.format(name, level['size'][0], level['size'][1], tag)
+            self.record(key, {'seconds': statistics.median(times), 'best': min(times)}, mp_per_s=mp)
+            self.results[key]['error'] = abs(level['score'] - full)
+            logging.info('%s: error %.4f', key, self.results[key]['error'])
+
+    def similarity(self):
+        path = tempfile.mkdtemp(prefix='benchmark_')
+        try:
+            for size in self.sizes:
+                mp = size[0] * size[1] / 1e6
+                tag = '{}x{}'.format(*size)
+                base = numpy.asarray(synthetic_image(size, 1))
+                quotes = [numpy.asarray(synthetic_image(size, i)) for i in range(2, 10)]
+                entropy = EntropySimilarity(base)
+                cosine = CosineSimilarity(base)
+                diff = DiffSimilarity(base)
+                self.record('entropy.compare/{}'.format(tag), measure(lambda: entropy.compare(quotes[0]), self.repeat), mp_per_s=mp)
+                self.record('cosine.compare/{}'.format(tag), measure(lambda: cosine.compare(quotes[0]), self.repeat), mp_per_s=mp)
+                self.record('cosine.compare_many/{}'.format(tag), measure(lambda: cosine.compare_many(quotes), self.repeat), mp_per_s=mp * len(quotes))
+                output = os.path.join(path, 'diff.png')
+                self.record('diff.compare/{}'.format(tag), measure(lambda: diff.compare(quotes[0], output), self.repeat), mp_per_s=mp)
+                # JPEG files, so that the low levels are decoded at a reduced size
+                files = [os.path.join(path, '{}.jpg'.format(i)) for i in range(2)]
+                for f, image in zip(files, (base, quotes[0])):
+                    Image.fromarray(image).save(f, quality=90)
+                self.pyramid('entropy', EntropySimilarity(files[0]), files[1], tag, mp)
+                self.pyramid('cosine', CosineSimilarity(files[0]), files[1], tag, mp)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def video(self):
+        for size in self.video_sizes:
+            path = tempfile.mkdtemp(prefix='benchmark_')
+            tag = '{}x{}'.format(*size)
+            try:
+                file_in = synthetic_video(os.path.join(path, 'input.mp4'), size, self.frames)
+                options = dict(strength=10, font_path=FONTS_PATH, copies=2, ciphers=init_ciphers('en'))
+                random.seed(0)
+                encoder = Encoder(file_in, os.path.join(path, 'encode'), **options)
+                # Every copy is a full output video
+                frames = self.frames * len(encoder.ciphers)
+                self.record('encoder.run/{}'.format(tag), measure(lambda: encoder.run(show_progress=False), self.repeat), fps=frames)
+                self.record('encoder.run.smart/{}'.format(tag), measure(lambda: encoder.run(show_progress=False, smart=True), self.repeat), fps=frames)
+                with io.open(os.path.join(path, 'encode', 'conf.json'), 'r', encoding='utf8') as f:
+                    conf = json.load(f)
+                decoder = Decoder(os.path.join(path, 'encode', '0.mp4'), os.path.join(path, 'decode.png'), conf['positions'], conf['locations'], conf['resolution'], conf['font']['size'])
+                self.record('decoder.run/{}'.format(tag), measure(lambda: decoder.run(0, show_progress=False), self.repeat), fps=self.frames)
+                self.record('decoder.run.scan/{}'.format(tag), measure(lambda: decoder.run(0, show_progress=False, sparse=False), self.repeat), fps=self.frames)
+                shard = max(self.frames // 4, 1)
+                for stream_copy in (False, True):
+                    suffix = '.stream_copy' if stream_copy else ''
+                    path_split = os.path.join(path, 'split{}'.format(suffix))
+
+                    def clean():
+                        shutil.rmtree(path_split, ignore_errors=True)
+
+                    self.record('splitter.run{}/{}'.format(suffix, tag), measure(
+                        lambda: Splitter(file_in, path_split, shard).run(show_progress=False, stream_copy=stream_copy), self.repeat, clean
+                    ), fps=self.frames)
+                    shards = []
+                    for i in sorted((i for i in os.listdir(path_split) if i.endswith('.mp4')), key=lambda i: int(i[:-4])):
+                        random.seed(0)
+                        Encoder(os.path.join(path_split, i), os.path.join(path_split, i[:-4]), **options).run(show_progress=False)
+                        shards.append(Shard(os.path.join(path_split, i[:-4], '0.mp4'), os.path.join(path_split, i[:-4], 'conf.json'), 0))
+                    shard_out = Shard(os.path.join(path, 'assemble{}.mp4'.format(suffix)), os.path.join(path, 'assemble{}.json'.format(suffix)))
+                    self.record('assembler.run{}/{}'.format(suffix, tag), measure(
+                        lambda: Assembler(shards, shard_out).run(show_progress=False, stream_copy=stream_copy), self.repeat
+                    ), fps=self.frames)
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def run(self):
+        for group in self.groups:
+            getattr(self, group)()
+        return {
+            'meta': {
+                't': datetime.now().timestamp(),
+                'handler': platform.node(),
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'cpus': os.cpu_count(),
+                'repeat': self.repeat
+            },
+            'results': self.results
+        }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compare the median times with a baseline
+    :param threshold: relative slowdown reported as a regression
+    :return: a dict of name => {'baseline', 'seconds', 'ratio', 'regression'}, and the names of the regressions
+    """
+    comparison = dict()
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if before is None or not before.get('seconds'):
+            continue
+        ratio = result['seconds'] / before['seconds']
+        comparison[name] = {'baseline': before['seconds'], 'seconds': result['seconds'], 'ratio': ratio, 'regression': ratio > 1 + threshold}
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return comparison, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=str, default='640x480,1280x720', help='image sizes, default: 640x480,1280x720')
+    parser.add_argument('-v', '--video-sizes', type=str, default='320x240,640x360', help='video sizes, default: 320x240,640x360')
+    parser.add_argument('-n', '--frames', type=int, default=60, help='# of frames of the video, default: 60')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='# of runs of every benchmark, the median is kept, default: 3')
+    parser.add_argument('-g', '--groups', type=str, default=','.join(GROUPS), help='benchmark groups, default: {}'.format(','.join(GROUPS)))
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json', help='output JSON file, default: benchmark.json')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='baseline JSON file to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1, help='relative slowdown reported as a regression, default: 0.1')
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    groups = [i for i in args.groups.split(',') if i]
+    for i in groups:
+        if i not in GROUPS:
+            parser.error('unknown group: {}'.format(i))
+    output = Benchmark(
+        sizes=[parse_size(i) for i in args.sizes.split(',') if i],
+        video_sizes=[parse_size(i) for i in args.video_sizes.split(',') if i],
+        frames=args.frames,
+        repeat=args.repeat,
+        groups=groups
+    ).run()
+    regressions = []
+    if args.baseline:
+        with io.open(args.baseline, 'r', encoding='utf8') as f:
+            output['comparison'], regressions = compare(output, json.load(f), args.threshold)
+        for i in regressions:
+            logging.error('Regression: %s is %.2fx slower than the baseline', i, output['comparison'][i]['ratio'])
+    with io.open(args.output, 'w', encoding='utf8') as f:
+        json.dump(output, f, indent=2, ensure_ascii=False)
+    logging.info('Results are saved: %s', args.output)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,30 @@
+import time
+from contextlib import contextmanager
+
+# Callables called with (stage, seconds), e.g. the Prometheus histograms of the Django service.
+# The modules only time their stages when something listens, so they do not depend on any metrics library.
+_listeners = []
+
+
+def listen(callback):
+    _listeners.append(callback)
+
+
+def observe(stage: str, seconds: float):
+    for i in _listeners:
+        i(stage, seconds)
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    Time the body of a with statement as a stage
+    """
+    if not _listeners:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t)
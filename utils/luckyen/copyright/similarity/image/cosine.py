@@ -5,31 +5,124 @@ import cv2
 import numpy
 from PIL import Image
 from deeputils.logger import setup_log
+from scipy.ndimage import uniform_filter
 from skimage.metrics import structural_similarity
 
+from utils.luckyen.copyright.similarity.image import pyramid
+
+# Parameters of structural_similarity, compare_many reproduces its default settings
+WIN_SIZE = 7
+K1 = 0.01
+K2 = 0.03
+
+# Scores of compare_pyramid within this range are refined at the next level. Near duplicates score above it and
+# unrelated images below it from 256 pixels up, though SSIM drops as the resolution grows and only scores of the
+# same level compare with each other
+AMBIGUOUS = (0.7, 0.95)
+
 
 class CosineSimilarity:
-    def __init__(self, f_base: str):
-        self.image_base = cv2.imread(f_base)
+    def __init__(self, f_base):
+        self.f_base = f_base
+        self._image_base = None
+
+    @property
+    def image_base(self):
+        # Decoded on first use, compare_pyramid may not need the full resolution
+        if self._image_base is None:
+            self._image_base = self.f_base if isinstance(self.f_base, numpy.ndarray) else cv2.imread(self.f_base)
+        return self._image_base
+
+    @staticmethod
+    def _score(image1, image2, multichannel=True):
+        images = [image1, image2]
+        if not multichannel:
+            images = [numpy.array(Image.fromarray(i).convert('1')) for i in images]
+        return structural_similarity(images[0], images[1], multichannel=multichannel)
 
-    def compare(self, f_quote: str, multichannel=True):
-        images = [self.image_base.copy(), cv2.imread(f_quote)]
+    def compare(self, f_quote, multichannel=True):
+        images = [self.image_base, f_quote if isinstance(f_quote, numpy.ndarray) else cv2.imread(f_quote)]
         shape_min = (min([i.shape[1] for i in images]), min([i.shape[0] for i in images]))
         logging.debug('Comparing size: %s', shape_min)
         for i in range(len(images)):
-            images[i] = Image.fromarray(images[i]).resize(shape_min, Image.ANTIALIAS)
-            if not multichannel:
-                images[i] = images[i].convert('1')
+            images[i] = Image.fromarray(images[i])
+            if images[i].size != shape_min:
+                # Cached features already share the same size
+                images[i] = images[i].resize(shape_min, Image.ANTIALIAS)
             images[i] = numpy.array(images[i])
-        return structural_similarity(images[0], images[1], multichannel=multichannel)
+        return self._score(images[0], images[1], multichannel)
+
+    def compare_pyramid(self, f_quote, multichannel=True, levels=pyramid.LEVELS, ambiguous=AMBIGUOUS):
+        """
+        Compare at the working sizes of the levels first, JPEG files being decoded at a reduced size, and only refine at
+        the next level when the score is ambiguous
+        :param ambiguous: (low, high) SSIM range refined at the next level, None scores every level up to the full
+            resolution, to measure the error of each level
+        :return: the SSIM of the last level computed, and a list of {'size', 'score', 'ms'} for every level computed
+        """
+        base = self.f_base if self._image_base is None else self._image_base
+        return pyramid.compare(lambda a, b: self._score(a, b, multichannel), base, f_quote, levels, ambiguous)
+
+    @staticmethod
+    def _prepare(image, shape, multichannel):
+        image = Image.fromarray(image)
+        if image.size != shape:
+            image = image.resize(shape, Image.ANTIALIAS)
+        if not multichannel:
+            image = image.convert('1')
+        image = numpy.asarray(image, dtype=numpy.float64)
+        # Filter the channels (or the single channel) one by one, as structural_similarity does
+        return image if multichannel else image[:, :, None]
+
+    def compare_many(self, f_quotes: list, multichannel=True, batch_size=32):
+        """
+        Compare many images against the base image in a vectorized SSIM, equivalent to calling compare on each of them.
+        The local means and variances of the base image are computed once, the candidates are stacked and filtered together.
+        All images are resized to the smallest width and height of the whole batch, which matches compare as long as the
+        candidates share the same size, e.g. cached features.
+        :param f_quotes: a list of file paths or arrays as returned by cv2.imread
+        :param batch_size: # of candidates filtered at once, bounds the memory used
+        :return: an array of SSIM scores, in the order of f_quotes
+        """
+        quotes = [i if isinstance(i, numpy.ndarray) else cv2.imread(i) for i in f_quotes]
+        if not quotes:
+            return numpy.empty(0)
+        images = [self.image_base] + quotes
+        shape_min = (min([i.shape[1] for i in images]), min([i.shape[0] for i in images]))
+        logging.debug('Comparing size: %s x %d', shape_min, len(quotes))
+        # Binary images have a data range of 1, uint8 ones of 255
+        data_range = 255 if multichannel else 1
+        c1 = (K1 * data_range) ** 2
+        c2 = (K2 * data_range) ** 2
+        cov_norm = WIN_SIZE ** 2 / (WIN_SIZE ** 2 - 1)
+        base = self._prepare(self.image_base, shape_min, multichannel)
+        ux = uniform_filter(base, size=(WIN_SIZE, WIN_SIZE, 1))
+        vx = cov_norm * (uniform_filter(base * base, size=(WIN_SIZE, WIN_SIZE, 1)) - ux * ux)
+        pad = (WIN_SIZE - 1) // 2
+        size = (1, WIN_SIZE, WIN_SIZE, 1)
+        scores = list()
+        for i in range(0, len(quotes), batch_size):
+            batch = numpy.stack([self._prepare(j, shape_min, multichannel) for j in quotes[i:i + batch_size]])
+            uy = uniform_filter(batch, size=size)
+            vy = cov_norm * (uniform_filter(batch * batch, size=size) - uy * uy)
+            vxy = cov_norm * (uniform_filter(batch * base, size=size) - ux * uy)
+            s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+            scores.append(s[:, pad:s.shape[1] - pad, pad:s.shape[2] - pad].mean(axis=(1, 2, 3)))
+        return numpy.concatenate(scores)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('--color', action='store_true', help='compare colors (multi-channel)')
+    parser.add_argument('--pyramid', type=str, default=None, help='compare at these working sizes first, e.g. 256,1024, and print every level')
     parser.add_argument('image1', type=str, help='image 1')
     parser.add_argument('image2', type=str, help='image 2')
     args, _ = parser.parse_known_args()
     setup_log(logging.DEBUG if args.debug else logging.INFO)
-    print(CosineSimilarity(f_base=args.image1).compare(args.image2, args.color))
+    if args.pyramid is None:
+        print(CosineSimilarity(f_base=args.image1).compare(args.image2, args.color))
+    else:
+        score, report = CosineSimilarity(f_base=args.image1).compare_pyramid(args.image2, args.color, [int(i) for i in args.pyramid.split(',') if i], None)
+        for i in report:
+            print('{}x{}\t{:.4f}\t{:.1f} ms'.format(i['size'][0], i['size'][1], i['score'], i['ms']))
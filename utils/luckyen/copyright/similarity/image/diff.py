@@ -8,15 +8,19 @@ from deeputils.logger import setup_log
 
 
 class DiffSimilarity:
-    def __init__(self, f_base: str):
-        self.image_base = cv2.imread(f_base)
+    def __init__(self, f_base):
+        self.image_base = f_base if isinstance(f_base, numpy.ndarray) else cv2.imread(f_base)
 
-    def compare(self, f_quote: str, output=None):
-        images = [self.image_base.copy(), cv2.imread(f_quote)]
+    def compare(self, f_quote, output=None):
+        images = [self.image_base, f_quote if isinstance(f_quote, numpy.ndarray) else cv2.imread(f_quote)]
         shape_min = (min([i.shape[1] for i in images]), min([i.shape[0] for i in images]))
         logging.debug('Comparing size: %s', shape_min)
         for i in range(len(images)):
-            images[i] = numpy.array(Image.fromarray(images[i]).resize(shape_min, Image.ANTIALIAS))
+            images[i] = Image.fromarray(images[i])
+            if images[i].size != shape_min:
+                # Cached features already share the same size
+                images[i] = images[i].resize(shape_min, Image.ANTIALIAS)
+            images[i] = numpy.array(images[i])
         img = ImageOps.invert(Image.fromarray(images[1] - images[0], 'RGB'))
         img.save(output)
 
@@ -7,27 +7,66 @@ from PIL import Image
 from deeputils.logger import setup_log
 from skimage.metrics import variation_of_information
 
+from utils.luckyen.copyright.similarity.image import pyramid
+
+# Scores of compare_pyramid within this range are refined at the next level. Near duplicates score below it and
+# unrelated images above it from 256 pixels up, though the variation of information grows with the resolution and
+# only scores of the same level compare with each other
+AMBIGUOUS = (2.5, 4.0)
+
 
 class EntropySimilarity:
-    def __init__(self, f_base: str):
-        self.image_base = cv2.imread(f_base)
+    def __init__(self, f_base):
+        self.f_base = f_base
+        self._image_base = None
 
+    @property
+    def image_base(self):
+        # Decoded on first use, compare_pyramid may not need the full resolution
+        if self._image_base is None:
+            self._image_base = self.f_base if isinstance(self.f_base, numpy.ndarray) else cv2.imread(self.f_base)
+        return self._image_base
 
-    def compare(self, f_quote: str):
-        images = [self.image_base.copy(), cv2.imread(f_quote)]
+    @staticmethod
+    def _score(image1, image2):
+        return numpy.mean(variation_of_information(image1, image2))
+
+    def compare(self, f_quote):
+        images = [self.image_base, f_quote if isinstance(f_quote, numpy.ndarray) else cv2.imread(f_quote)]
         shape_min = (min([i.shape[1] for i in images]), min([i.shape[0] for i in images]))
         logging.debug('Comparing size: %s', shape_min)
         for i in range(len(images)):
-            images[i] = Image.fromarray(images[i]).resize(shape_min, Image.ANTIALIAS)
+            images[i] = Image.fromarray(images[i])
+            if images[i].size != shape_min:
+                # Cached features already share the same size
+                images[i] = images[i].resize(shape_min, Image.ANTIALIAS)
             images[i] = numpy.array(images[i])
-        return numpy.mean(variation_of_information(images[0], images[1]))
+        return self._score(images[0], images[1])
+
+    def compare_pyramid(self, f_quote, levels=pyramid.LEVELS, ambiguous=AMBIGUOUS):
+        """
+        Compare at the working sizes of the levels first, JPEG files being decoded at a reduced size, and only refine at
+        the next level when the score is ambiguous
+        :param ambiguous: (low, high) range of variation of information refined at the next level, None scores every
+            level up to the full resolution, to measure the error of each level
+        :return: the variation of information of the last level computed, and a list of {'size', 'score', 'ms'} for
+            every level computed
+        """
+        base = self.f_base if self._image_base is None else self._image_base
+        return pyramid.compare(self._score, base, f_quote, levels, ambiguous)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('--pyramid', type=str, default=None, help='compare at these working sizes first, e.g. 256,1024, and print every level')
     parser.add_argument('image1', type=str, help='image 1')
     parser.add_argument('image2', type=str, help='image 2')
     args, _ = parser.parse_known_args()
     setup_log(logging.DEBUG if args.debug else logging.INFO)
-    print(EntropySimilarity(f_base=args.image1).compare(args.image2))
+    if args.pyramid is None:
+        print(EntropySimilarity(f_base=args.image1).compare(args.image2))
+    else:
+        score, report = EntropySimilarity(f_base=args.image1).compare_pyramid(args.image2, [int(i) for i in args.pyramid.split(',') if i], None)
+        for i in report:
+            print('{}x{}\t{:.4f}\t{:.1f} ms'.format(i['size'][0], i['size'][1], i['score'], i['ms']))
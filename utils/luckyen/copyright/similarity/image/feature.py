@@ -0,0 +1,145 @@
+import argparse
+import fcntl
+import io
+import json
+import logging
+import os
+import threading
+
+import cv2
+import numpy
+from PIL import Image
+from deeputils.logger import setup_log
+
+FEATURE_SIZE = (128, 128)
+HEADER_SIZE = 64
+MAGIC = b'LUCKYFEA'
+NAME_SIZE = 64
+
+
+def feature(image, size=FEATURE_SIZE):
+    """
+    Normalized feature of an image: resized to a fixed size, in the BGR channel order of cv2.imread
+    :param image: a PIL image, a BGR array as returned by cv2.imread, or a file path
+    :param size: (width, height) of the feature
+    :return: an uint8 array of shape (height, width, 3)
+    """
+    if isinstance(image, str):
+        image = cv2.imread(image)
+    if isinstance(image, numpy.ndarray):
+        image = Image.fromarray(image[:, :, ::-1])
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return numpy.ascontiguousarray(numpy.asarray(image.resize(size, Image.ANTIALIAS))[:, :, ::-1])
+
+
+class FeatureStore:
+    """
+    Append-only arena of fixed size feature records, memory-mapped read-only by every process.
+    The file starts with a small header describing the feature shape, followed by records of
+    a zero padded name and the feature tensor.
+    """
+
+    def __init__(self, path: str, size=FEATURE_SIZE):
+        self.path = path
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        self.size = tuple(size)
+        self.dtype = numpy.dtype([('name', 'S{}'.format(NAME_SIZE)), ('feature', numpy.uint8, (self.size[1], self.size[0], 3))])
+        self.lock = threading.RLock()
+        self.records = None
+        self.rows = dict()
+        self.refresh()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.rows)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.rows
+
+    def _header(self):
+        return MAGIC + json.dumps({'size': self.size}).encode('utf8').ljust(HEADER_SIZE - len(MAGIC))
+
+    def refresh(self):
+        """
+        Map the records appended since the last refresh
+        """
+        with self.lock:
+            try:
+                file_size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                return
+            if file_size < HEADER_SIZE:
+                # The header is still being written
+                return
+            n = (file_size - HEADER_SIZE) // self.dtype.itemsize
+            if self.records is not None and n == len(self.records):
+                return
+            if self.records is None:
+                with io.open(self.path, 'rb') as f:
+                    if f.read(HEADER_SIZE) != self._header():
+                        raise ValueError('feature store {} does not match feature size {}'.format(self.path, self.size))
+            start = 0 if self.records is None else len(self.records)
+            self.records = numpy.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(n,)) if n else None
+            for i in range(start, n):
+                self.rows[self.records[i]['name'].decode('utf8')] = i
+
+    def add(self, name: str, image):
+        self.add_many([(name, image)])
+
+    def add_many(self, items):
+        """
+        Add many features at once
+        :param items: a list of (name, image or feature) tuples
+        """
+        records = numpy.zeros(len(items), dtype=self.dtype)
+        for i, (name, image) in enumerate(items):
+            data = name.encode('utf8')
+            if len(data) > NAME_SIZE:
+                raise ValueError('name is too long: {}'.format(name))
+            records[i]['name'] = data
+            is_feature = isinstance(image, numpy.ndarray) and image.shape == self.dtype['feature'].shape
+            records[i]['feature'] = image if is_feature else feature(image, self.size)
+        with self.lock:
+            with io.open(self.path, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # The size once locked, tell() is the size when the file was opened and another writer may have
+                # written the header since
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.write(self._header())
+                f.write(records.tobytes())
+                f.flush()
+            self.refresh()
+
+    def get(self, name: str):
+        """
+        Get the cached feature of an image
+        :return: a read-only array, or None if the image is not in the store
+        """
+        with self.lock:
+            if name not in self.rows:
+                self.refresh()
+            if name not in self.rows:
+                return None
+            return self.records[self.rows[name]]['feature']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('-s', '--store', type=str, required=True, help='feature store file path')
+    parser.add_argument('-n', '--size', type=int, default=FEATURE_SIZE[0], help='feature width and height, default: {}'.format(FEATURE_SIZE[0]))
+    parser.add_argument('files', type=str, nargs='+', help='image files, directories are added with all their marked images')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    store = FeatureStore(args.store, (args.size, args.size))
+    for i in args.files:
+        if os.path.isdir(i):
+            names = [j for j in sorted(os.listdir(i)) if 'marked' in j and j not in store]
+            for k in range(0, len(names), 256):
+                store.add_many([(j, os.path.join(i, j)) for j in names[k:k + 256]])
+        elif os.path.basename(i) not in store:
+            store.add(os.path.basename(i), i)
+    logging.info('# of features: %d', len(store))
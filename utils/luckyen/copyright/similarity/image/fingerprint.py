@@ -0,0 +1,287 @@
+import argparse
+import fcntl
+import heapq
+import io
+import json
+import logging
+import os
+import threading
+
+import numpy
+from PIL import Image
+from deeputils.logger import setup_log
+
+HASH_SIZE = 8
+
+
+def _pack(bits):
+    return int.from_bytes(numpy.packbits(bits.astype(numpy.uint8)).tobytes(), 'big')
+
+
+def _dct_matrix(n):
+    k = numpy.arange(n)
+    m = numpy.cos(numpy.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] *= numpy.sqrt(1 / n)
+    m[1:] *= numpy.sqrt(2 / n)
+    return m
+
+
+def dhash(image, size=HASH_SIZE):
+    """
+    Difference hash: sign of the horizontal gradient of a (size + 1) x size greyscale thumbnail
+    :return: an integer of size * size bits
+    """
+    pixels = numpy.asarray(image.convert('L').resize((size + 1, size), Image.BILINEAR), dtype=numpy.int16)
+    return _pack((pixels[:, 1:] > pixels[:, :-1]).flatten())
+
+
+def phash(image, size=HASH_SIZE, factor=4):
+    """
+    Perceptual hash: low frequency DCT coefficients of a greyscale thumbnail compared to their median
+    :return: an integer of size * size bits
+    """
+    n = size * factor
+    pixels = numpy.asarray(image.convert('L').resize((n, n), Image.BILINEAR), dtype=numpy.float64)
+    dct = _dct_matrix(n)
+    coefficients = dct.dot(pixels).dot(dct.T)[:size, :size]
+    return _pack((coefficients > numpy.median(coefficients)).flatten())
+
+
+def fingerprint(image, size=HASH_SIZE):
+    """
+    Concatenation of the dHash and pHash of an image, the Hamming distance between two fingerprints is a metric
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+        # Let the JPEG decoder downscale for us, the hashes only need a tiny thumbnail
+        image.draft('RGB', (size * 16, size * 16))
+    return (dhash(image, size) << (size * size)) | phash(image, size)
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer fingerprints with the Hamming distance.
+    A node keeps all the items sharing its fingerprint, removed items leave an empty routing node behind.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, key, item):
+        if self.root is None:
+            self.root = [key, {item}, {}]
+            return
+        node = self.root
+        while True:
+            d = distance(key, node[0])
+            if d == 0:
+                node[1].add(item)
+                return
+            if d not in node[2]:
+                node[2][d] = [key, {item}, {}]
+                return
+            node = node[2][d]
+
+    def remove(self, key, item):
+        node = self.root
+        while node is not None:
+            d = distance(key, node[0])
+            if d == 0:
+                node[1].discard(item)
+                return
+            node = node[2].get(d)
+
+    def nearest(self, key, k=1, radius=None):
+        """
+        Find the k nearest items
+        :param key: the fingerprint to look for
+        :param k: # of items to return
+        :param radius: maximum distance, unlimited if not provided
+        :return: a list of (distance, item) tuples, nearest first
+        """
+        results = []
+        if self.root is None or k <= 0:
+            return results
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = distance(key, node[0])
+            if radius is None or d <= radius:
+                for item in node[1]:
+                    heapq.heappush(results, (-d, item))
+                    if len(results) > k:
+                        heapq.heappop(results)
+            bound = radius
+            if len(results) == k and (bound is None or -results[0][0] < bound):
+                bound = -results[0][0]
+            for child_distance, child in node[2].items():
+                if bound is None or abs(child_distance - d) <= bound:
+                    stack.append(child)
+        return sorted((-d, item) for d, item in results)
+
+
+class FingerprintIndex:
+    """
+    Persistent fingerprint index backed by an append-only log of JSON lines.
+    Every process keeps its own BK-tree and replays the records appended by other processes before searching.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        self.lock = threading.RLock()
+        self.entries = dict()
+        self.tree = BKTree()
+        self.inode = None
+        self.offset = 0
+        self.refresh()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.entries)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.entries
+
+    def _apply(self, record):
+        name = record['name']
+        if name in self.entries:
+            self.tree.remove(self.entries.pop(name), name)
+        if record['op'] == 'add':
+            self.entries[name] = int(record['hash'], 16)
+            self.tree.add(self.entries[name], name)
+
+    def refresh(self):
+        """
+        Replay the records appended since the last refresh, or reload everything after a compaction
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if stat.st_ino != self.inode:
+                self.entries = dict()
+                self.tree = BKTree()
+                self.inode = stat.st_ino
+                self.offset = 0
+            if stat.st_size <= self.offset:
+                return
+            with io.open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Ignore a trailing line that is still being written
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                if line.strip():
+                    self._apply(json.loads(line.decode('utf8')))
+            self.offset += len(data)
+
+    def _open_locked(self):
+        while True:
+            f = io.open(self.path, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            # The log was compacted while waiting for the lock
+            f.close()
+
+    def _append(self, records):
+        with self.lock:
+            f = self._open_locked()
+            try:
+                f.write(b''.join(json.dumps(i).encode('utf8') + b'\n' for i in records))
+                f.flush()
+            finally:
+                f.close()
+            self.refresh()
+
+    def add(self, name: str, image=None, key: int = None):
+        self.add_many([(name, key if key is not None else fingerprint(image))])
+
+    def add_many(self, items):
+        """
+        Add many items at once
+        :param items: a list of (name, fingerprint) tuples
+        """
+        self._append([{'op': 'add', 'name': name, 'hash': '{:x}'.format(h)} for name, h in items])
+
+    def remove(self, name: str):
+        self.remove_many([name])
+
+    def remove_many(self, names):
+        self.refresh()
+        names = [i for i in names if i in self.entries]
+        if names:
+            self._append([{'op': 'del', 'name': i} for i in names])
+
+    def compact(self, exists=None):
+        """
+        Rewrite the log with only the live entries
+        :param exists: optional callable, entries for which it returns False are dropped
+        :return: # of live entries
+        """
+        with self.lock:
+            f = self._open_locked()
+            try:
+                self.refresh()
+                entries = {k: v for k, v in self.entries.items() if exists is None or exists(k)}
+                temp = '{}.{}.tmp'.format(self.path, os.getpid())
+                with io.open(temp, 'wb') as t:
+                    for name in sorted(entries):
+                        t.write(json.dumps({'op': 'add', 'name': name, 'hash': '{:x}'.format(entries[name])}).encode('utf8') + b'\n')
+                    t.flush()
+                    os.fsync(t.fileno())
+                os.replace(temp, self.path)
+            finally:
+                f.close()
+            self.refresh()
+            logging.info('Fingerprint index compacted: %d entries', len(self.entries))
+            return len(self.entries)
+
+    def search(self, image, k: int = 10, radius: int = None):
+        """
+        Find the nearest indexed items of an image
+        :param image: a PIL image, a file path, or a fingerprint
+        :return: a list of (distance, name) tuples, nearest first
+        """
+        h = image if isinstance(image, int) else fingerprint(image)
+        with self.lock:
+            self.refresh()
+            return self.tree.nearest(h, k, radius)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('-x', '--index', type=str, required=True, help='index file path')
+    parser.add_argument('-k', type=int, default=10, help='# of candidates to search, default: 10')
+    parser.add_argument('action', type=str, choices=['add', 'remove', 'compact', 'search'], help='action, add, remove, compact or search')
+    parser.add_argument('files', type=str, nargs='*', help='image files, directories are added with all their marked images')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    index = FingerprintIndex(args.index)
+    if args.action == 'add':
+        for i in args.files:
+            if os.path.isdir(i):
+                index.add_many([(j, fingerprint(os.path.join(i, j))) for j in sorted(os.listdir(i)) if 'marked' in j])
+            else:
+                index.add(os.path.basename(i), i)
+    elif args.action == 'remove':
+        index.remove_many([os.path.basename(i) for i in args.files])
+    elif args.action == 'compact':
+        index.compact()
+    elif args.action == 'search':
+        for i in args.files:
+            for d, name in index.search(i, args.k):
+                print('{}\t{}\t{}'.format(i, name, d))
+    logging.info('# of entries: %d', len(index))
@@ -0,0 +1,152 @@
+import heapq
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+from utils.luckyen.copyright.similarity.image.cosine import CosineSimilarity
+from utils.luckyen.copyright.similarity.image.entropy import EntropySimilarity
+from utils.luckyen.copyright.similarity.image.feature import FeatureStore, FEATURE_SIZE, feature
+
+# Similarity class and whether a higher score means more similar
+SIMILARITIES = {
+    'entropy': (EntropySimilarity, False),
+    'ssim': (CosineSimilarity, True),
+}
+
+# Shortlists of at most this many chunks are scored in the current process, starting the workers would cost more
+LOCAL_CHUNKS = 2
+
+# Per process state of the workers, only set in the worker processes
+_store = None
+_root = ''
+_size = FEATURE_SIZE
+
+
+def _init(store_path, size, root):
+    global _store, _root, _size
+    _store = FeatureStore(store_path, size) if store_path else None
+    _root = root
+    _size = size
+
+
+def _load(name):
+    cached = _store.get(name) if _store is not None else None
+    if cached is None:
+        cached = feature(os.path.join(_root, name), _size)
+    return cached
+
+
+def _top(method, query, names, k, load=_load):
+    """
+    Score a chunk of candidates and keep its k best
+    :return: a list of (key, name, score) tuples, the smallest key being the best
+    """
+    cls, higher = SIMILARITIES[method]
+    similarity = cls(query)
+    if hasattr(similarity, 'compare_many'):
+        scores = similarity.compare_many([load(name) for name in names])
+    else:
+        scores = [similarity.compare(load(name)) for name in names]
+    results = [(-float(score) if higher else float(score), name, float(score)) for name, score in zip(names, scores)]
+    return heapq.nsmallest(k, results)
+
+
+def _top_chunk(args):
+    return _top(*args)
+
+
+def python_executable():
+    """
+    The interpreter the workers are spawned with, an embedded interpreter such as uWSGI reports its own binary as
+    sys.executable
+    """
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    for name in ('python{}.{}'.format(*sys.version_info[:2]), 'python3', 'python'):
+        path = os.path.join(sys.exec_prefix, 'bin', name)
+        if os.path.exists(path):
+            return path
+    return sys.executable
+
+
+class ParallelScorer:
+    """
+    Score candidates with the similarity classes across a persistent pool of processes.
+    Candidates are split into chunks, every chunk returns its own top k and the chunks are merged
+    as they complete, so the full list of scores is never built nor sorted.
+    The workers are spawned rather than forked, the pool is started from request threads of a
+    multithreaded server, and every worker opens its own feature store. Short lists are scored in the
+    current process, and so is everything once the pool failed.
+    """
+
+    def __init__(self, store_path: str = None, size=FEATURE_SIZE, root: str = '', workers: int = None, chunk_size: int = 4,
+                 timeout: float = 30):
+        self.store_path = store_path
+        self.size = tuple(size)
+        self.root = root
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self.timeout = timeout
+        self.pool = None
+        self.failed = False
+        self.lock = threading.Lock()
+        logging.debug('Parallel scorer: %d workers, %d candidates per chunk', self.workers, self.chunk_size)
+
+    def _pool(self):
+        # Created on first use, in the process that scores
+        with self.lock:
+            if self.pool is None:
+                context = multiprocessing.get_context('spawn')
+                context.set_executable(python_executable())
+                self.pool = context.Pool(self.workers, initializer=_init, initargs=(self.store_path, self.size, self.root))
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    def _local(self, query, names, method, k, load):
+        if load is None:
+            def load(name):
+                return feature(os.path.join(self.root, name), self.size)
+        return [(name, score) for _, name, score in _top(method, query, names, k, load)]
+
+    def score(self, query, names, method='entropy', k=1, load=None):
+        """
+        Score the candidates against a query
+        :param query: the feature array of the query image
+        :param names: candidate names, resolved through the feature store or the root path
+        :param method: a key of SIMILARITIES
+        :param k: # of best candidates to return
+        :param load: a callable returning the feature array of a candidate name when it is scored in the current
+            process, e.g. through the store already opened by the caller, the root path is read if not provided
+        :return: a list of (name, score) tuples, best first
+        """
+        if method not in SIMILARITIES:
+            raise ValueError('method must be one of {}'.format(', '.join(SIMILARITIES)))
+        names = list(names)
+        if self.failed or self.workers <= 1 or len(names) <= self.chunk_size * LOCAL_CHUNKS:
+            return self._local(query, names, method, k, load)
+        chunks = [(method, query, names[i:i + self.chunk_size], k) for i in range(0, len(names), self.chunk_size)]
+        best = []
+        try:
+            results = self._pool().imap_unordered(_top_chunk, chunks)
+            for _ in chunks:
+                # A killed worker never returns its chunk
+                for item in results.next(self.timeout):
+                    if len(best) < k:
+                        heapq.heappush(best, (-item[0], item[1], item[2]))
+                    elif item[0] < -best[0][0]:
+                        heapq.heapreplace(best, (-item[0], item[1], item[2]))
+        except multiprocessing.TimeoutError:
+            # The workers did not start or one was killed, do not make every request wait for the timeout
+            logging.exception('Scoring pool timed out, scoring in the current process from now on')
+            self.failed = True
+            self.shutdown()
+            return self._local(query, names, method, k, load)
+        return [(name, score) for _, name, score in sorted((-key, name, score) for key, name, score in best)]
@@ -0,0 +1,96 @@
+import logging
+import time
+
+import cv2
+import numpy
+from PIL import Image
+
+# Working sizes of the levels, as their longest side in pixels, the full resolution is always the last level
+LEVELS = (256, 1024)
+
+# cv2.imread flags decoding a JPEG at 1/8, 1/4 or 1/2 of its size straight from the DCT coefficients
+REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# EXIF orientations that cv2.imread turns by 90 degrees
+TRANSPOSED = (5, 6, 7, 8)
+
+
+def level_shape(shape, size):
+    """
+    :param shape: the full resolution comparing size (width, height)
+    :param size: longest side of the level, None for the full resolution
+    :return: (width, height) keeping the aspect ratio, never larger than shape
+    """
+    if size is None or max(shape) <= size:
+        return tuple(shape)
+    scale = size / max(shape)
+    return max(1, int(round(shape[0] * scale))), max(1, int(round(shape[1] * scale)))
+
+
+class Source:
+    """
+    An image decoded at the lowest resolution a level needs, a file is only decoded at full resolution when a level
+    needs it and every decoded resolution is kept for the next levels
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.images = dict()
+        if isinstance(f, numpy.ndarray):
+            self.size = (f.shape[1], f.shape[0])
+            self.images[1] = f
+        else:
+            # Only the header is read here
+            with Image.open(f) as image:
+                self.size = image.size
+                if image.format == 'JPEG' and image.getexif().get(0x0112) in TRANSPOSED:
+                    self.size = self.size[::-1]
+
+    def read(self, shape):
+        """
+        :return: an array at least as large as shape
+        """
+        factor, flag = 1, cv2.IMREAD_COLOR
+        if not isinstance(self.f, numpy.ndarray):
+            for i, j in REDUCED:
+                if min(self.size) // i >= max(shape):
+                    factor, flag = i, j
+                    break
+        if factor not in self.images:
+            self.images[factor] = cv2.imread(self.f, flag)
+        return self.images[factor]
+
+
+def resize(image, shape):
+    if (image.shape[1], image.shape[0]) == shape:
+        return image
+    return numpy.array(Image.fromarray(image).resize(shape, Image.ANTIALIAS))
+
+
+def compare(score, f_base, f_quote, levels=LEVELS, ambiguous=None):
+    """
+    Score two images from the lowest level up, stopping at the first level whose score is not ambiguous
+    :param score: a callable scoring two arrays of the same shape
+    :param f_base: a file path or an array as returned by cv2.imread
+    :param f_quote: a file path or an array as returned by cv2.imread
+    :param levels: working sizes of the levels below the full resolution, as their longest side
+    :param ambiguous: (low, high), a score strictly within is refined at the next level, None refines up to the
+        full resolution
+    :return: the score of the last level computed, and a list of {'size', 'score', 'ms'} for every level computed
+    """
+    sources = [Source(f_base), Source(f_quote)]
+    shape_min = (min([i.size[0] for i in sources]), min([i.size[1] for i in sources]))
+    shapes = []
+    for size in sorted(levels) + [None]:
+        shape = level_shape(shape_min, size)
+        if shape not in shapes:
+            shapes.append(shape)
+    report = []
+    for shape in shapes:
+        t = time.perf_counter()
+        result = float(score(*[resize(i.read(shape), shape) for i in sources]))
+        report.append({'size': shape, 'score': result, 'ms': (time.perf_counter() - t) * 1000})
+        logging.debug('Level %s: %.4f in %.1f ms', shape, result, report[-1]['ms'])
+        if ambiguous is not None and not ambiguous[0] < result < ambiguous[1]:
+            break
+    return result, report
@@ -0,0 +1,98 @@
+import logging
+import time
+
+import numpy
+
+from utils.luckyen.copyright import metrics
+from utils.luckyen.copyright.similarity.image.cosine import CosineSimilarity
+from utils.luckyen.copyright.similarity.image.entropy import EntropySimilarity
+
+COARSE = ('hash', 'correlation')
+FINE = ('entropy', 'ssim')
+
+
+def thumbnail(image, size=32):
+    """
+    Greyscale block average of a feature array, used by the correlation stage
+    """
+    grey = numpy.asarray(image, dtype=numpy.float64).mean(axis=2)
+    h, w = grey.shape[0] // size * size, grey.shape[1] // size * size
+    return grey[:h, :w].reshape(size, h // size, size, w // size).mean(axis=(1, 3))
+
+
+def correlation(a, b):
+    """
+    1 - Pearson correlation of two thumbnails, 0 when identical
+    """
+    a = a - a.mean()
+    b = b - b.mean()
+    norm = numpy.sqrt((a * a).sum() * (b * b).sum())
+    if norm == 0:
+        return 1.0
+    return 1.0 - float((a * b).sum() / norm)
+
+
+class TwoStageRanker:
+    """
+    Coarse-to-fine ranking: a cheap stage (hash distance or low resolution correlation) keeps the top k
+    candidates, then only those are scored with EntropySimilarity or the SSIM of CosineSimilarity,
+    in the current process or with a ParallelScorer.
+    """
+
+    def __init__(self, query, coarse='hash', fine='entropy', k=5, scorer=None):
+        if coarse not in COARSE:
+            raise ValueError('coarse stage must be one of {}'.format(', '.join(COARSE)))
+        if fine not in FINE:
+            raise ValueError('fine stage must be one of {}'.format(', '.join(FINE)))
+        if k < 1:
+            raise ValueError('k must be positive')
+        self.query = query
+        self.coarse = coarse
+        self.fine = fine
+        self.k = k
+        self.scorer = scorer
+
+    def _coarse(self, candidates, load):
+        if self.coarse == 'hash':
+            return [(name, float(d)) for d, name in candidates]
+        query = thumbnail(self.query)
+        return [(name, correlation(query, thumbnail(load(name)))) for _, name in candidates]
+
+    def _fine(self, shortlist, load):
+        if self.scorer is not None:
+            return self.scorer.score(self.query, shortlist, self.fine, len(shortlist), load)
+        if self.fine == 'ssim':
+            scores = CosineSimilarity(self.query).compare_many([load(name) for name in shortlist])
+            return [(name, float(score)) for name, score in zip(shortlist, scores)]
+        similarity = EntropySimilarity(self.query)
+        return [(name, float(similarity.compare(load(name)))) for name in shortlist]
+
+    def rank(self, candidates, load):
+        """
+        Rank the candidates
+        :param candidates: a list of (hash distance, name) tuples, as returned by FingerprintIndex.search
+        :param load: a callable returning the feature array of a candidate name
+        :return: a dict with the best (name, score), the scores of both stages, and their timings in milliseconds
+        """
+        t = time.perf_counter()
+        coarse = sorted(self._coarse(candidates, load), key=lambda i: i[1])
+        shortlist = [name for name, _ in coarse[:self.k]]
+        t_coarse = time.perf_counter() - t
+        t = time.perf_counter()
+        fine = self._fine(shortlist, load)
+        # Variation of information is a distance, SSIM is a similarity
+        fine.sort(key=lambda i: i[1], reverse=self.fine == 'ssim')
+        t_fine = time.perf_counter() - t
+        metrics.observe('ranking.coarse.{}'.format(self.coarse), t_coarse)
+        metrics.observe('ranking.fine.{}'.format(self.fine), t_fine)
+        logging.debug('Ranked %d candidates (%s, %.1f ms) and %d shortlisted (%s, %.1f ms)',
+                      len(coarse), self.coarse, t_coarse * 1000, len(fine), self.fine, t_fine * 1000)
+        return {
+            'best': fine[0] if fine else None,
+            'coarse': coarse,
+            'fine': fine,
+            'timings': {
+                'coarse': t_coarse * 1000,
+                'fine': t_fine * 1000
+            }
+        }
@@ -0,0 +1,125 @@
+import argparse
+import logging
+import os
+
+import imageio_ffmpeg
+import numpy
+from PIL import Image
+from deeputils.common import progress
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.similarity.image.fingerprint import fingerprint
+
+# Frames are decoded to greyscale squares of this size, queries are resized the same way
+FRAME_SIZE = 128
+THUMBNAIL_SIZE = 16
+CACHE_SUFFIX = '.frames.npz'
+MASK = (1 << 64) - 1
+
+
+def normalize(image):
+    """
+    Greyscale square of an image, as ffmpeg decodes the frames for the fingerprints
+    :param image: a PIL image or a file path
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+        image.draft('RGB', (FRAME_SIZE * 2, FRAME_SIZE * 2))
+    return numpy.asarray(image.convert('L').resize((FRAME_SIZE, FRAME_SIZE), Image.BILINEAR))
+
+
+def describe(grey):
+    """
+    :param grey: a greyscale square as returned by normalize
+    :return: the fingerprint and the block averaged thumbnail
+    """
+    n = FRAME_SIZE // THUMBNAIL_SIZE
+    thumbnail = grey.reshape(THUMBNAIL_SIZE, n, THUMBNAIL_SIZE, n).mean(axis=(1, 3))
+    return fingerprint(Image.fromarray(grey)), numpy.rint(thumbnail).astype(numpy.uint8)
+
+
+def hamming(hashes, key):
+    """
+    Hamming distances between many fingerprints and one
+    :param hashes: a uint64 array of shape (n, 2), the high and low halves of the fingerprints
+    :return: an int array of shape (n,)
+    """
+    x = numpy.bitwise_xor(hashes, numpy.array([key >> 64, key & MASK], dtype=numpy.uint64))
+    return numpy.unpackbits(numpy.ascontiguousarray(x).view(numpy.uint8), axis=1).sum(axis=1)
+
+
+class FrameFingerprints:
+    """
+    Fingerprint and greyscale thumbnail of every frame of a video, built in one streaming pass where ffmpeg
+    downscales the frames, and cached next to the video until the video changes
+    """
+
+    def __init__(self, file_in: str, cache: str = None, show_progress=False):
+        self.file = file_in
+        self.cache = cache or '{}{}'.format(file_in, CACHE_SUFFIX)
+        loaded = self.load()
+        self.hashes, self.thumbnails = loaded if loaded is not None else self.build(show_progress)
+        logging.info('# of frame fingerprints: %d', len(self))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def stamp(self):
+        stat = os.stat(self.file)
+        return numpy.array([stat.st_size, int(stat.st_mtime)], dtype=numpy.int64)
+
+    def load(self):
+        if not os.path.exists(self.cache):
+            return None
+        with numpy.load(self.cache) as data:
+            if not numpy.array_equal(data['stamp'], self.stamp()) or data['thumbnails'].shape[1:] != (THUMBNAIL_SIZE, THUMBNAIL_SIZE):
+                logging.info('Frame fingerprints are outdated: %s', self.cache)
+                return None
+            return data['hashes'], data['thumbnails']
+
+    def build(self, show_progress=False):
+        frames = imageio_ffmpeg.read_frames(self.file, pix_fmt='gray', bpp=1, output_params=['-vf', 'scale={0}:{0}'.format(FRAME_SIZE)])
+        meta = next(frames)
+        total = int(round(meta.get('duration', 0) * meta.get('fps', 0)))
+        hashes, thumbnails = [], []
+        for i, frame in enumerate(frames):
+            if show_progress and total:
+                progress(min(i, total - 1), total)
+            key, thumbnail = describe(numpy.frombuffer(frame, dtype=numpy.uint8).reshape(FRAME_SIZE, FRAME_SIZE))
+            hashes.append((key >> 64, key & MASK))
+            thumbnails.append(thumbnail)
+        if show_progress:
+            print()
+        hashes = numpy.array(hashes, dtype=numpy.uint64).reshape(-1, 2)
+        thumbnails = numpy.array(thumbnails, dtype=numpy.uint8).reshape(-1, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        temp = '{}.{}.tmp.npz'.format(self.cache, os.getpid())
+        numpy.savez(temp, stamp=self.stamp(), hashes=hashes, thumbnails=thumbnails)
+        os.replace(temp, self.cache)
+        logging.info('Frame fingerprints are cached: %s', self.cache)
+        return hashes, thumbnails
+
+    def nearest(self, image, k=50):
+        """
+        Shortlist the frames nearest to an image by fingerprint distance, ties broken by thumbnail difference
+        :param image: a PIL image or a file path
+        :return: a list of (frame number, fingerprint distance), nearest first
+        """
+        key, thumbnail = describe(normalize(image))
+        distances = hamming(self.hashes, key)
+        differences = numpy.abs(self.thumbnails.astype(numpy.int16) - thumbnail).reshape(len(self), -1).sum(axis=1)
+        order = numpy.lexsort((differences, distances))[:k]
+        return [(int(i), int(distances[i])) for i in order]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, default=10, help='# of frames to shortlist, default: 10')
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('video', type=str, help='input video')
+    parser.add_argument('image', type=str, nargs='*', help='images to look for')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    frame_fingerprints = FrameFingerprints(args.video, show_progress=True)
+    for i in args.image:
+        for n, d in frame_fingerprints.nearest(i, args.k):
+            print('{}\t{}\t{}'.format(i, n, d))
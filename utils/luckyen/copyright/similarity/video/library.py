@@ -0,0 +1,271 @@
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.similarity.video.frames import FrameFingerprints, MASK, THUMBNAIL_SIZE, describe, hamming, normalize
+
+# The 128 bits fingerprints are cut into bands of 16 bits, two fingerprints within a distance of BANDS - 1
+# share at least one band, which is looked up in the inverted index
+BANDS = 8
+BAND_BITS = 16
+
+
+def bands(hashes):
+    """
+    :param hashes: a uint64 array of shape (n, 2)
+    :return: a uint16 array of shape (n, BANDS)
+    """
+    shifts = numpy.arange(64 - BAND_BITS, -1, -BAND_BITS, dtype=numpy.uint64)
+    return ((hashes[:, :, None] >> shifts) & numpy.uint64((1 << BAND_BITS) - 1)).reshape(len(hashes), BANDS).astype(numpy.uint16)
+
+
+def empty_index():
+    return {
+        'names': [],
+        'ids': {},
+        'hashes': numpy.empty((0, 2), dtype=numpy.uint64),
+        'thumbnails': numpy.empty((0, THUMBNAIL_SIZE, THUMBNAIL_SIZE), dtype=numpy.uint8),
+        'owners': numpy.empty(0, dtype=numpy.int32),
+        'frames': numpy.empty(0, dtype=numpy.int32),
+        'live': numpy.empty(0, dtype=bool),
+        'order': numpy.empty((0, BANDS), dtype=numpy.int32),
+        'keys': numpy.empty((0, BANDS), dtype=numpy.uint16)
+    }
+
+
+class VideoLibrary:
+    """
+    Frame fingerprints of a whole library of videos, to find the video and the frame an image comes from.
+    Videos are recorded in an append-only log of JSON lines with their fingerprints in one file per video, every process
+    replays the log and keeps an inverted index from the bands of the fingerprints to the frames, in memory.
+    The index is updated in place of being rebuilt when videos change: the fingerprints of the videos added are merged
+    into the sorted bands and the frames of the videos removed are masked, until most of the frames are masked.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        self.log = os.path.join(self.path, 'videos.log')
+        self.lock = threading.RLock()
+        self.videos = dict()
+        self.offset = 0
+        self.index = None
+        # Videos added or removed since the index was last updated
+        self.changed = set()
+        self.refresh()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.videos)
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self.videos
+
+    def refresh(self):
+        """
+        Replay the records appended since the last refresh, the inverted index is updated on the next search if any
+        """
+        with self.lock:
+            try:
+                size = os.path.getsize(self.log)
+            except FileNotFoundError:
+                return
+            if size <= self.offset:
+                return
+            with io.open(self.log, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Ignore a trailing line that is still being written
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                if line.strip():
+                    record = json.loads(line.decode('utf8'))
+                    if record['op'] == 'add':
+                        self.videos[record['name']] = record
+                    else:
+                        self.videos.pop(record['name'], None)
+                    self.changed.add(record['name'])
+            self.offset += len(data)
+
+    def _append(self, record):
+        with self.lock:
+            with io.open(self.log, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps(record, ensure_ascii=False).encode('utf8') + b'\n')
+                f.flush()
+            self.refresh()
+
+    def add(self, file_in: str, name: str = None, show_progress=False):
+        """
+        Add a video, or update it if it has changed since it was added
+        :param name: the name of the video in the results, default: the file name
+        :return: # of frames
+        """
+        name = name or os.path.basename(file_in)
+        frame_fingerprints = FrameFingerprints(file_in, show_progress=show_progress)
+        data = '{}.npz'.format(hashlib.sha1(name.encode('utf8')).hexdigest()[:16])
+        temp = os.path.join(self.path, '{}.{}.tmp.npz'.format(data, os.getpid()))
+        numpy.savez(temp, hashes=frame_fingerprints.hashes, thumbnails=frame_fingerprints.thumbnails)
+        os.replace(temp, os.path.join(self.path, data))
+        self._append({'op': 'add', 'name': name, 'file': os.path.abspath(file_in), 'frames': len(frame_fingerprints), 'data': data, 't': time.time()})
+        logging.info('Video is added: %s (%d frames)', name, len(frame_fingerprints))
+        return len(frame_fingerprints)
+
+    def remove(self, name: str):
+        self.refresh()
+        record = self.videos.get(name)
+        if record is not None:
+            self._append({'op': 'del', 'name': name})
+            try:
+                os.remove(os.path.join(self.path, record['data']))
+            except FileNotFoundError:
+                pass
+            logging.info('Video is removed: %s', name)
+
+    def build(self):
+        """
+        Load the fingerprints of every video and sort every band once, then only load the videos changed since
+        """
+        with self.lock:
+            self.refresh()
+            if self.index is not None and not self.changed:
+                return self.index
+            t = time.perf_counter()
+            if self.index is None:
+                index, names = empty_index(), sorted(self.videos)
+            else:
+                index = self._mask(self.index, self.changed)
+                names = sorted(name for name in self.changed if name in self.videos)
+                if index['live'].sum() * 2 < len(index['live']):
+                    logging.info('Most frames of the video library index are removed, rebuilding it')
+                    index, names = empty_index(), sorted(self.videos)
+            self.index = self._merge(index, names)
+            self.changed = set()
+            logging.info('Video library index is updated: %d videos, %d frames in %.1f ms', len(self.index['ids']), int(self.index['live'].sum()), (time.perf_counter() - t) * 1000)
+            return self.index
+
+    @staticmethod
+    def _mask(index, names):
+        """
+        Mask the frames of videos, the arrays changed are copied since searches may still be running on the index
+        """
+        index = dict(index, ids=dict(index['ids']), live=index['live'].copy())
+        for name in names:
+            if name in index['ids']:
+                index['live'][index['owners'] == index['ids'].pop(name)] = False
+        return index
+
+    def _merge(self, index, names):
+        """
+        Load the fingerprints of videos and insert them into the sorted bands
+        """
+        hashes, thumbnails, owners, frames = [], [], [], []
+        for name in names:
+            with numpy.load(os.path.join(self.path, self.videos[name]['data'])) as data:
+                hashes.append(data['hashes'])
+                thumbnails.append(data['thumbnails'])
+            owners.append(numpy.full(len(hashes[-1]), len(index['names']) + len(frames), dtype=numpy.int32))
+            frames.append(numpy.arange(len(hashes[-1]), dtype=numpy.int32))
+        if not names:
+            return index
+        hashes = numpy.concatenate(hashes)
+        keys = bands(hashes)
+        # For every band, the rows sorted by band value and the sorted values to search in
+        order = numpy.argsort(keys, axis=0, kind='stable').astype(numpy.int32)
+        keys = numpy.take_along_axis(keys, order, axis=0)
+        n = len(index['hashes'])
+        merged_keys = numpy.empty((n + len(hashes), BANDS), dtype=numpy.uint16)
+        merged_order = numpy.empty((n + len(hashes), BANDS), dtype=numpy.int32)
+        for b in range(BANDS):
+            # After the equal values already in the band, as a stable sort of all the rows would order them
+            positions = numpy.searchsorted(index['keys'][:, b], keys[:, b], side='right')
+            merged_keys[:, b] = numpy.insert(index['keys'][:, b], positions, keys[:, b])
+            merged_order[:, b] = numpy.insert(index['order'][:, b], positions, order[:, b] + n)
+        ids = dict(index['ids'])
+        ids.update((name, len(index['names']) + i) for i, name in enumerate(names))
+        return {
+            'names': index['names'] + names,
+            'ids': ids,
+            'hashes': numpy.concatenate([index['hashes'], hashes]),
+            'thumbnails': numpy.concatenate([index['thumbnails']] + thumbnails),
+            'owners': numpy.concatenate([index['owners']] + owners),
+            'frames': numpy.concatenate([index['frames']] + frames),
+            'live': numpy.concatenate([index['live'], numpy.ones(len(hashes), dtype=bool)]),
+            'order': merged_order,
+            'keys': merged_keys
+        }
+
+    def search(self, image, k: int = 10, radius: int = None):
+        """
+        Find the frames nearest to an image across the library
+        :param image: a PIL image or a file path
+        :param k: # of hits to return
+        :param radius: maximum fingerprint distance, frames sharing no band with the image are only scanned if there
+            are less than k frames sharing one, default: no limit
+        :return: a list of (video name, frame number, score, fingerprint distance), best first, the score is the
+            share of identical bits of the fingerprints
+        """
+        index = self.build()
+        if not index['live'].any():
+            return []
+        key, thumbnail = describe(normalize(image))
+        query = bands(numpy.array([[key >> 64, key & MASK]], dtype=numpy.uint64))[0]
+        rows = []
+        for b in range(BANDS):
+            lo = numpy.searchsorted(index['keys'][:, b], query[b], side='left')
+            hi = numpy.searchsorted(index['keys'][:, b], query[b], side='right')
+            rows.append(index['order'][lo:hi, b])
+        rows = numpy.unique(numpy.concatenate(rows))
+        rows = rows[index['live'][rows]]
+        if len(rows) < k:
+            logging.debug('Only %d frames share a band, scanning all the frames', len(rows))
+            rows = numpy.flatnonzero(index['live'])
+        distances = hamming(index['hashes'][rows], key)
+        if radius is not None:
+            rows, distances = rows[distances <= radius], distances[distances <= radius]
+        differences = numpy.abs(index['thumbnails'][rows].astype(numpy.int16) - thumbnail).reshape(len(rows), -1).sum(axis=1)
+        best = numpy.lexsort((differences, distances))[:k]
+        return [(
+            index['names'][index['owners'][rows[i]]],
+            int(index['frames'][rows[i]]),
+            1 - float(distances[i]) / (BANDS * BAND_BITS),
+            int(distances[i])
+        ) for i in best]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('-x', '--library', type=str, required=True, help='library path')
+    parser.add_argument('-k', type=int, default=10, help='# of hits to return, default: 10')
+    parser.add_argument('-r', '--radius', type=int, default=None, help='maximum fingerprint distance, default: no limit')
+    parser.add_argument('action', type=str, choices=['add', 'remove', 'search'], help='action, add, remove or search')
+    parser.add_argument('files', type=str, nargs='*', help='videos to add or remove, or images to search')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    library = VideoLibrary(args.library)
+    if args.action == 'add':
+        for i in args.files:
+            library.add(i, show_progress=True)
+    elif args.action == 'remove':
+        for i in args.files:
+            library.remove(os.path.basename(i))
+    elif args.action == 'search':
+        for i in args.files:
+            t = time.perf_counter()
+            hits = library.search(i, args.k, args.radius)
+            logging.info('Searched in %.1f ms', (time.perf_counter() - t) * 1000)
+            for name, frame, score, d in hits:
+                print('{}\t{}\t{}\t{:.4f}\t{}'.format(i, name, frame, score, d))
+    logging.info('# of videos: %d', len(library))
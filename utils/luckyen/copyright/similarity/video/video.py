@@ -3,13 +3,14 @@ import logging
 import os
 import uuid
 
-import cv2
 import imageio
+import numpy
 import requests
 from PIL import Image
-from deeputils.common import progress
 from deeputils.logger import setup_log
-from skimage.measure import compare_ssim
+
+from utils.luckyen.copyright.similarity.image.cosine import CosineSimilarity
+from utils.luckyen.copyright.similarity.video.frames import FrameFingerprints
 
 
 class Similarity:
@@ -31,22 +32,38 @@ class Similarity:
             logging.info('Callback is enabled: %s %s', self.callback[0], self.callback[1])
         logging.info('Similarity comparator is successfully initialized.')
 
-    def compare(self, file_in: str):
-        m = cv2.imread(file_in)
-        similarities = list()
-        for i in range(len(self.video)):
-            progress(i, len(self.video))
-            if i == 720:
+    def search(self, file_in: str, k: int = 5, shortlist: int = 50, batch_size: int = 8):
+        """
+        Find the frames of the video most similar to an image: frames are shortlisted by fingerprint distance,
+        with fingerprints cached next to the video, then only the shortlist is scored with SSIM
+        :param k: # of frames to return
+        :param shortlist: # of frames to score with SSIM
+        :param batch_size: # of frames decoded and scored at once
+        :return: a list of (frame number, SSIM, fingerprint distance), best first
+        """
+        image = Image.open(file_in).convert('RGB')
+        candidates = FrameFingerprints(self.file).nearest(image, max(shortlist, k))
+        similarity = CosineSimilarity(numpy.asarray(image.resize((self.shape[1], self.shape[0]), Image.BILINEAR)))
+        results = list()
+        # Read the frames in order, so that close frames are reached by decoding forward, and score them in small batches
+        candidates.sort()
+        for i in range(0, len(candidates), batch_size):
+            frames = list()
+            for n, d in candidates[i:i + batch_size]:
                 try:
-                    score = compare_ssim(self.video.get_data(i), m, multichannel=True)
+                    frames.append((n, d, self.video.get_data(n)[:, :, :3]))
                 except imageio.core.format.CannotReadFrameError:
-                    score = 0
-            else:
-                score = 0
-            similarities.append(score)
-        print()
-        k = max(similarities)
-        n = similarities.index(k)
+                    results.append((n, 0.0, d))
+            scores = similarity.compare_many([j[2] for j in frames], batch_size=batch_size)
+            results += [(n, float(score), d) for (n, d, _), score in zip(frames, scores)]
+        results.sort(key=lambda i: i[1], reverse=True)
+        return results[:k]
+
+    def compare(self, file_in: str, k: int = 5, shortlist: int = 50):
+        results = self.search(file_in, k, shortlist)
+        for n, score, d in results:
+            logging.info('Frame %d: similarity %f, fingerprint distance %d', n, score, d)
+        n, k, _ = results[0]
         logging.info('Max similarity (%f) in frame: %d', k, n)
         Image.fromarray(self.video.get_data(n)).save(os.path.join(self.out, '{}.jpg'.format(self.task_id)))
         if self.callback is not None:
@@ -58,11 +75,14 @@ class Similarity:
                 }
             })
 
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output', type=str, default='./', help='output path, default: ./')
     parser.add_argument('--id', type=str, default=str(uuid.uuid4()), help='task ID, a random ID will be generated if not provided')
+    parser.add_argument('-k', type=int, default=5, help='# of best frames to show, default: 5')
+    parser.add_argument('-n', '--shortlist', type=int, default=50, help='# of frames to score with SSIM, default: 50')
+    parser.add_argument('--callback-method', type=str, default='post', help='callback HTTP method, default: post')
+    parser.add_argument('--callback-url', type=str, default=None, help='callback URL, no callback if not provided')
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('video', type=str, help='input video, must be MP4 format')
     parser.add_argument('image', type=str, help='input image, must be JPG format')
@@ -73,4 +93,4 @@ if __name__ == "__main__":
         path_out=args.output,
         callback=(args.callback_method, args.callback_url) if args.callback_url else None,
         task_id=args.id
-    ).compare(args.image)
+    ).compare(args.image, args.k, args.shortlist)
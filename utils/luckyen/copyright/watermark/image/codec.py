@@ -0,0 +1,73 @@
+import argparse
+import io
+import logging
+import time
+
+from PIL import Image
+from deeputils.logger import setup_log
+
+# File extension of every format
+FORMATS = {
+    'png': 'png',
+    'webp': 'webp',
+    'jpeg': 'jpg',
+}
+PRESETS = ('fast', 'balanced', 'small')
+
+# Image.save options of every format and preset, JPEG is lossy and only kept for compatibility
+OPTIONS = {
+    'png': {
+        'fast': {'format': 'PNG', 'compress_level': 1},
+        'balanced': {'format': 'PNG', 'compress_level': 6},
+        'small': {'format': 'PNG', 'compress_level': 9},
+    },
+    'webp': {
+        'fast': {'format': 'WEBP', 'lossless': True, 'method': 0, 'quality': 0},
+        'balanced': {'format': 'WEBP', 'lossless': True, 'method': 4, 'quality': 50},
+        'small': {'format': 'WEBP', 'lossless': True, 'method': 6, 'quality': 100},
+    },
+    'jpeg': {
+        'fast': {'format': 'JPEG', 'quality': 100, 'subsampling': 0},
+        'balanced': {'format': 'JPEG', 'quality': 95, 'subsampling': 0, 'optimize': True},
+        'small': {'format': 'JPEG', 'quality': 90, 'subsampling': 2, 'optimize': True, 'progressive': True},
+    },
+}
+
+
+class Codec:
+    """
+    Output stage of the marked images: lossless PNG or WebP with speed/size presets, or JPEG for compatibility,
+    which loses the low nibble SSIS.extract and the payload rely on
+    """
+
+    def __init__(self, format='png', preset='fast'):
+        if format not in FORMATS:
+            raise ValueError('format must be one of {}'.format(', '.join(FORMATS)))
+        if preset not in PRESETS:
+            raise ValueError('preset must be one of {}'.format(', '.join(PRESETS)))
+        self.format = format
+        self.preset = preset
+        self.extension = FORMATS[format]
+
+    def save(self, image, output):
+        """
+        :param image: a PIL image
+        :param output: a file path or a file object
+        """
+        image.save(output, **OPTIONS[self.format][self.preset])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('img', type=str, help='image path')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    image = Image.open(args.img).convert('RGB')
+    # Compare the size and the latency of every format and preset on an image
+    for f in FORMATS:
+        for p in PRESETS:
+            buffer = io.BytesIO()
+            t = time.perf_counter()
+            Codec(f, p).save(image, buffer)
+            print('{}\t{}\t{:.0f} KB\t{:.1f} ms'.format(f, p, len(buffer.getvalue()) / 1024, (time.perf_counter() - t) * 1000))
@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from PIL import Image
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.metrics import timer
+from utils.luckyen.copyright.watermark.image.codec import Codec, FORMATS, PRESETS
+from utils.luckyen.copyright.watermark.image.ssis import SSIS, FONTS_PATH
+
+
+class EncodePipeline:
+    """
+    Produce many SSIS marked variants of one decoded source image.
+    The source pixels and their high nibble plane are shared by all variants, and every variant
+    (secret rendering, merging and compression) runs in its own thread, since numpy and the PIL
+    codecs release the GIL for the heavy parts.
+    """
+
+    def __init__(self, image, font_path=FONTS_PATH, chars=16, workers=None):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        self.size = image.size
+        self.pixels = numpy.asarray(image)
+        self.high = self.pixels & 0xF0
+        self.font_path = font_path
+        self.chars = chars
+        self.workers = workers
+        logging.debug('Encode pipeline is initialized: %s', self.size)
+
+    def variant(self, secret=None, payload=None):
+        """
+        Build one marked variant
+        :param secret: the secret image, a random one will be generated if not provided
+        :param payload: optional encoded payload, as returned by payload.encode
+        :return: the marked image
+        """
+        if secret is None:
+            with timer('ssis.secret'):
+                secret = SSIS.secret(self.size, self.font_path, self.chars)
+        if secret.mode != 'RGB':
+            secret = secret.convert('RGB')
+        if secret.size[0] > self.size[0] or secret.size[1] > self.size[1]:
+            raise ValueError('secret image should not be larger than the source image')
+        with timer('ssis.merge'):
+            return Image.fromarray(SSIS.merge_array(self.pixels, numpy.asarray(secret), self.high, payload), 'RGB')
+
+    def run(self, outputs, callback=None, payloads=None, codec=None, **save_options):
+        """
+        Build and save one variant per output
+        :param outputs: a list of file paths or file objects
+        :param callback: optional callable, called with (output, image) from the worker once a variant is saved
+        :param payloads: optional list of encoded payloads, one per output
+        :param codec: optional Codec saving the variants, save_options are used without it
+        :param save_options: options passed to Image.save, e.g.: format='JPEG', quality=100
+        :return: the outputs
+        """
+        if not outputs:
+            return outputs
+
+        def work(output, payload=None):
+            image = self.variant(payload=payload)
+            with timer('image.save'):
+                if codec is not None:
+                    codec.save(image, output)
+                else:
+                    image.save(output, **save_options)
+            if callback is not None:
+                callback(output, image)
+
+        workers = self.workers or min(len(outputs), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume the results to re-raise errors from the workers
+            list(executor.map(work, outputs, payloads or [None] * len(outputs)))
+        return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('-i', '--img', type=str, required=True, help='image path, must in .jpg format')
+    parser.add_argument('-p', '--path', type=str, default='.', help='output file path, default: .')
+    parser.add_argument('-n', '--number', type=int, default=3, help='# of variants, default: 3')
+    parser.add_argument('-w', '--words', type=int, default=16, help='# of watermarks, default: 16')
+    parser.add_argument('-f', '--font', type=str, default=FONTS_PATH, help='font path, default: ./fonts/mono.ttf')
+    parser.add_argument('--format', type=str, default='png', choices=list(FORMATS), help='output format, default: png')
+    parser.add_argument('--preset', type=str, default='fast', choices=PRESETS, help='speed/size preset, default: fast')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    output_codec = Codec(args.format, args.preset)
+    EncodePipeline(Image.open(args.img), args.font, args.words).run(
+        ['{}/output_{}.{}'.format(args.path, i, output_codec.extension) for i in range(args.number)],
+        codec=output_codec
+    )
@@ -3,10 +3,13 @@ import logging
 import random
 import os
 
+import numpy
 from PIL import Image, ImageDraw, ImageFont
 from deeputils.common import random_chars
 from deeputils.logger import setup_log
 
+from utils.luckyen.copyright.watermark.image import payload as payload_codec
+
 PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FONTS_PATH = PATH + '/image/fonts/mono.ttf'
 
@@ -57,7 +60,85 @@ class SSIS:
         return rgb
 
     @staticmethod
-    def merge(img1, img2):
+    def __visible(pixels):
+        """
+        Mask of the pixels carrying information, i.e. neither black nor white
+        :param pixels: an uint8 array of shape (height, width, 3)
+        :return: a boolean array of shape (height, width)
+        """
+        return ~((pixels == 0).all(axis=2) | (pixels == 255).all(axis=2))
+
+    @staticmethod
+    def merge(img1, img2, payload=None):
+        """
+        :param payload: optional encoded payload, as returned by payload.encode, written under the secret
+        """
+        # Check the images dimensions
+        if img2.size[0] > img1.size[0] or img2.size[1] > img1.size[1]:
+            raise ValueError('image 2 should not be larger than image 1')
+        if img1.mode != 'RGB' or img2.mode != 'RGB':
+            if payload is not None:
+                raise ValueError('a payload can only be merged into RGB images')
+            return SSIS._merge_reference(img1, img2)
+        return Image.fromarray(SSIS.merge_array(numpy.asarray(img1), numpy.asarray(img2), payload=payload), img1.mode)
+
+    @staticmethod
+    def merge_array(pixels1, pixels2, high=None, payload=None):
+        """
+        Merge two RGB arrays, the array version of merge
+        :param pixels1: an uint8 array of shape (height, width, 3)
+        :param pixels2: an uint8 array no larger than pixels1
+        :param high: optional precomputed ``pixels1 & 0xF0``, shared when merging many secrets into one image
+        :param payload: optional encoded payload, written to the low nibble of every pixel of image 1 before the secret,
+            so that it is left in the pixels the secret does not cover. The low nibble of image 1 is lost, see payload.embed
+        :return: a new uint8 array with the two images merged
+        """
+        pixels_new = pixels1.copy()
+        if payload is not None:
+            payload_codec.embed(pixels_new, payload)
+        # Only the area covered by the second image can carry information
+        h, w = pixels2.shape[:2]
+        region = pixels_new[:h, :w]
+        visible = SSIS.__visible(pixels2)
+        if high is None:
+            high = region[visible] & 0xF0
+        else:
+            high = high[:h, :w][visible]
+        # Keep the high nibble of image 1 and take the low nibble of image 2
+        region[visible] = high | (pixels2[visible] & 0x0F)
+        return pixels_new
+
+    @staticmethod
+    def extract(img):
+        if img.mode != 'RGB':
+            return SSIS._extract_reference(img)
+        # Move the last 4 bits (corresponding to the hidden image) to the high nibble
+        pixels_new = (numpy.asarray(img) & 0x0F) << 4
+        # Crop at the last 'valid' pixel in column-major order, as the reference does
+        valid = pixels_new.any(axis=2)
+        columns = numpy.flatnonzero(valid.any(axis=0))
+        if columns.size:
+            x = columns[-1]
+            y = numpy.flatnonzero(valid[:, x])[-1]
+            pixels_new = pixels_new[:y + 1, :x + 1]
+        return Image.fromarray(numpy.ascontiguousarray(pixels_new), img.mode)
+
+    @staticmethod
+    def extract_payload(img, key):
+        """
+        Read the payload merged into an image, one pass whatever the number of marked images
+        :param key: the key the payload was encoded with
+        :return: the ID, or None if the image carries no payload or it does not match the key
+        """
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return payload_codec.decode(payload_codec.read(numpy.asarray(img)), key)
+
+    @staticmethod
+    def _merge_reference(img1, img2):
+        """
+        Per-pixel reference implementation of merge, kept to check the vectorized path against
+        """
         # Check the images dimensions
         if img2.size[0] > img1.size[0] or img2.size[1] > img1.size[1]:
             raise ValueError('image 2 should not be larger than image 1')
@@ -83,7 +164,10 @@ class SSIS:
         return new_image
 
     @staticmethod
-    def extract(img):
+    def _extract_reference(img):
+        """
+        Per-pixel reference implementation of extract, kept to check the vectorized path against
+        """
         # Load the pixel map
         pixel_map = img.load()
         # Create the new image and load the pixel map
@@ -111,19 +195,37 @@ class SSIS:
         return new_image
 
     @staticmethod
-    def secret(resolution, font_path=FONTS_PATH, chars=16):
-        img = Image.new('RGB', resolution, color=(255, 255, 255))
-        font = ImageFont.truetype(font_path, size=int(resolution[0] / 2 / chars))
+    def layout(resolution, chars=16):
+        """
+        Random characters of a secret image
+        :return: a list of ((x, y), char, (r, g, b)) tuples
+        """
+        return [(
+            (random.randrange(0, resolution[0]), random.randrange(0, resolution[0])),
+            random_chars(1),
+            (random.randrange(0, 255), random.randrange(0, 255), random.randrange(0, 255))
+        ) for _ in range(chars)]
+
+    @staticmethod
+    def font(resolution, font_path=FONTS_PATH, chars=16):
+        return ImageFont.truetype(font_path, size=int(resolution[0] / 2 / chars))
+
+    @staticmethod
+    def draw(img, layout, font, offset=(0, 0)):
+        """
+        Draw the characters of a layout on an image
+        :param offset: position of the image in the secret, to draw one part of it
+        """
         d = ImageDraw.Draw(img)
-        for i in range(chars):
-            d.text(
-                (random.randrange(0, resolution[0]), random.randrange(0, resolution[0])),
-                random_chars(1),
-                fill=(random.randrange(0, 255), random.randrange(0, 255), random.randrange(0, 255)),
-                font=font
-            )
+        for (x, y), char, fill in layout:
+            d.text((x - offset[0], y - offset[1]), char, fill=fill, font=font)
         return img
 
+    @staticmethod
+    def secret(resolution, font_path=FONTS_PATH, chars=16):
+        img = Image.new('RGB', resolution, color=(255, 255, 255))
+        return SSIS.draw(img, SSIS.layout(resolution, chars), SSIS.font(resolution, font_path, chars))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -132,6 +234,8 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--path', type=str, default='.', help='output file path, default: .')
     parser.add_argument('-w', '--words', type=int, default=16, help='# of watermarks, default: 16')
     parser.add_argument('-f', '--font', type=str, default='./fonts/mono.ttf', help='font path, default: ./fonts/mono.ttf')
+    parser.add_argument('--id', type=int, default=None, help='ID to merge as a payload')
+    parser.add_argument('--key', type=str, default=None, help='key of the payload, decode reads the payload when given')
     parser.add_argument('action', type=str, choices=['encode', 'decode'], help='action, encode or decode')
     args, _ = parser.parse_known_args()
     setup_log(logging.DEBUG if args.debug else logging.INFO)
@@ -140,6 +244,9 @@ if __name__ == "__main__":
     if args.action == 'encode':
         ssis_secret = ssis.secret(ssis_image.size, args.font, args.words)
         ssis_secret.save('{}/secret.png'.format(args.path))
-        ssis.merge(ssis_image, ssis_secret).save('{}/output.jpg'.format(args.path), format='JPEG', subsampling=0, quality=100)
+        ssis_payload = None if args.id is None else payload_codec.encode(args.id, args.key or '')
+        ssis.merge(ssis_image, ssis_secret, ssis_payload).save('{}/output.jpg'.format(args.path), format='JPEG', subsampling=0, quality=100)
     elif args.action == 'decode':
+        if args.key is not None:
+            print(ssis.extract_payload(ssis_image, args.key))
         ssis.extract(ssis_image).save('{}/extract.png'.format(args.path))
@@ -0,0 +1,307 @@
+import argparse
+import io
+import logging
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+
+import numpy
+from PIL import BmpImagePlugin, Image, PpmImagePlugin, TiffImagePlugin
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.watermark.image import payload as payload_codec
+from utils.luckyen.copyright.watermark.image.ssis import SSIS, FONTS_PATH
+
+# Pixels processed at once, the strips are as many rows as fit in it
+STRIP_PIXELS = 1 << 22
+
+# Image classes of the formats read strip by strip
+RAW_FORMATS = (TiffImagePlugin.TiffImageFile, PpmImagePlugin.PpmImageFile, BmpImagePlugin.BmpImageFile)
+
+
+def header(file_in):
+    """
+    Parse the header of an uncompressed image with the image classes, unlike Image.open they do not check the size
+    against Image.MAX_IMAGE_PIXELS, which is left as is for the other threads since the pixels are read strip by strip
+    :return: the size and the tiles of the image, no tiles if it is not RGB
+    """
+    with io.open(file_in, 'rb') as f:
+        for cls in RAW_FORMATS:
+            f.seek(0)
+            try:
+                image = cls(f, file_in)
+            except (SyntaxError, OSError):
+                continue
+            return image.size, [tuple(i) for i in image.tile] if image.mode == 'RGB' else []
+    raise ValueError('not an uncompressed RGB image: {}'.format(file_in))
+
+
+class RawReader:
+    """
+    Rows of an uncompressed RGB image (TIFF, PPM, BMP), read from the file as they are needed.
+    Pillow parses the header, its raw tiles give where every band of rows is stored.
+    """
+
+    def __init__(self, file_in):
+        self.size, tiles = header(file_in)
+        self.bands = []
+        for name, box, offset, args in [i[:4] for i in tiles]:
+            # Raw decoder arguments are (rawmode, stride=0, orientation=1)
+            args = (args,) if isinstance(args, str) else tuple(args)
+            rawmode, stride, orientation = args + (0, 1)[len(args) - 1:]
+            if name != 'raw' or rawmode not in ('RGB', 'BGR') or box[0] != 0 or box[2] != self.size[0]:
+                raise ValueError('not an uncompressed RGB image: {}'.format(file_in))
+            self.bands.append((box[1], box[3], offset, stride or self.size[0] * 3, rawmode, orientation))
+        if not self.bands:
+            raise ValueError('not an uncompressed RGB image: {}'.format(file_in))
+        self.f = io.open(file_in, 'rb')
+
+    def read(self, y0, y1):
+        """
+        :return: an uint8 array of shape (y1 - y0, width, 3)
+        """
+        w = self.size[0]
+        rows = numpy.empty((y1 - y0, w, 3), dtype=numpy.uint8)
+        for top, bottom, offset, stride, rawmode, orientation in self.bands:
+            a, b = max(y0, top), min(y1, bottom)
+            if a >= b:
+                continue
+            # Bottom-up bands store their last row first
+            first = a - top if orientation > 0 else bottom - b
+            self.f.seek(offset + first * stride)
+            data = numpy.frombuffer(self.f.read((b - a) * stride), dtype=numpy.uint8).reshape(b - a, stride)[:, :w * 3]
+            data = data.reshape(b - a, w, 3)
+            if orientation < 0:
+                data = data[::-1]
+            if rawmode == 'BGR':
+                data = data[:, :, ::-1]
+            rows[a - y0:b - y0] = data
+        return rows
+
+    def close(self):
+        self.f.close()
+
+
+class ImageReader:
+    """
+    Rows of any image Pillow can decode, the whole image is decoded in memory
+    """
+
+    def __init__(self, file_in):
+        logging.warning('%s is not an uncompressed RGB image, it is decoded in memory', file_in)
+        with Image.open(file_in) as image:
+            self.pixels = numpy.asarray(image.convert('RGB'))
+        self.size = (self.pixels.shape[1], self.pixels.shape[0])
+
+    def read(self, y0, y1):
+        return self.pixels[y0:y1].copy()
+
+    def close(self):
+        self.pixels = None
+
+
+def reader(file_in):
+    try:
+        return RawReader(file_in)
+    except ValueError:
+        return ImageReader(file_in)
+
+
+def png_filter(rows, previous=None):
+    """
+    Filter the rows of a RGB image with the PNG filter giving the smallest sum of absolute differences, as libpng does
+    :param rows: an uint8 array of shape (n, width, 3)
+    :param previous: the row above the first one, None for the first row of the image
+    :return: an uint8 array of shape (n, width * 3 + 1), every row starting with its filter type
+    """
+    x = rows.reshape(len(rows), -1)
+    up = numpy.empty_like(x)
+    up[0] = 0 if previous is None else previous.reshape(-1)
+    up[1:] = x[:-1]
+    left = numpy.zeros_like(x)
+    left[:, 3:] = x[:, :-3]
+    up_left = numpy.zeros_like(x)
+    up_left[:, 3:] = up[:, :-3]
+    # The Paeth predictor compares signed distances
+    left16, up16, up_left16 = left.astype(numpy.int16), up.astype(numpy.int16), up_left.astype(numpy.int16)
+    pa = numpy.abs(up16 - up_left16)
+    pb = numpy.abs(left16 - up_left16)
+    pc = numpy.abs(left16 + up16 - 2 * up_left16)
+    paeth = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, up, up_left))
+    # None, Sub, Up, Average, Paeth, uint8 arithmetic wraps around modulo 256 as PNG does
+    filtered = numpy.stack([x, x - left, x - up, x - ((left >> 1) + (up >> 1) + (left & up & 1)), x - paeth])
+    cost = numpy.abs(filtered.view(numpy.int8), dtype=numpy.int16).sum(axis=2, dtype=numpy.int32)
+    best = cost.argmin(axis=0)
+    output = numpy.empty((x.shape[0], x.shape[1] + 1), dtype=numpy.uint8)
+    output[:, 0] = best
+    output[:, 1:] = filtered[best, numpy.arange(x.shape[0])]
+    return output
+
+
+class PNGWriter:
+    """
+    Streaming PNG encoder, rows are filtered and deflated as they come and written as IDAT chunks
+    """
+
+    def __init__(self, file_out, size, level=6):
+        self.f = io.open(file_out, 'wb')
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits RGB, no interlacing
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(level)
+        self.previous = None
+
+    def chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def write(self, rows):
+        data = self.compressor.compress(png_filter(rows, self.previous).tobytes())
+        self.previous = rows[-1].copy()
+        if data:
+            self.chunk(b'IDAT', data)
+
+    def close(self):
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.f.close()
+
+
+class PPMWriter:
+    """
+    Binary PPM, the rows are written as they come and the output can be read back strip by strip
+    """
+
+    def __init__(self, file_out, size):
+        self.f = io.open(file_out, 'wb')
+        self.f.write('P6\n{} {}\n255\n'.format(*size).encode('ascii'))
+
+    def write(self, rows):
+        self.f.write(numpy.ascontiguousarray(rows).tobytes())
+
+    def close(self):
+        self.f.close()
+
+
+WRITERS = {
+    '.png': PNGWriter,
+    '.ppm': PPMWriter,
+}
+
+
+@contextmanager
+def writer(file_out, size):
+    extension = os.path.splitext(file_out)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError('output must be one of {}'.format(', '.join(WRITERS)))
+    w = WRITERS[extension](file_out, size)
+    try:
+        yield w
+    except BaseException:
+        w.f.close()
+        os.remove(file_out)
+        raise
+    w.close()
+
+
+class TiledSSIS:
+    """
+    SSIS for images too large to be held in memory, e.g. gigapixel scans. The image is processed in strips of rows,
+    the secret is rendered strip by strip from one random layout and the output is encoded as the strips come,
+    so the memory used depends on the width of the image and not on its height.
+    Uncompressed TIFF, PPM and BMP inputs are read strip by strip, other formats are decoded in memory first.
+    """
+
+    def __init__(self, file_in, strip_pixels=STRIP_PIXELS):
+        self.file_in = file_in
+        self.reader = reader(file_in)
+        self.size = self.reader.size
+        self.rows = max(1, strip_pixels // self.size[0])
+        logging.debug('Tiled SSIS: %s in strips of %d rows', self.size, self.rows)
+
+    def strips(self):
+        for y0 in range(0, self.size[1], self.rows):
+            yield y0, min(y0 + self.rows, self.size[1])
+
+    def merge(self, file_out, font_path=FONTS_PATH, chars=16, layout=None, payload=None):
+        """
+        Mark the image with a random secret, equivalent to SSIS.merge(image, SSIS.secret(image.size, font_path, chars))
+        :param file_out: a .png or .ppm file
+        :param layout: the characters of the secret as returned by SSIS.layout, a random one if not provided
+        :param payload: optional encoded payload, as returned by payload.encode
+        :return: the layout of the secret
+        """
+        layout = layout if layout is not None else SSIS.layout(self.size, chars)
+        font = SSIS.font(self.size, font_path, chars)
+        with writer(file_out, self.size) as w:
+            for y0, y1 in self.strips():
+                # Only the characters reaching the strip are drawn, a glyph never goes below twice the font size
+                drawn = [i for i in layout if i[0][1] < y1 and i[0][1] + 2 * font.size > y0]
+                secret = Image.new('RGB', (self.size[0], y1 - y0), color=(255, 255, 255))
+                SSIS.draw(secret, drawn, font, (0, y0))
+                rows = self.reader.read(y0, y1)
+                if payload is not None:
+                    payload_codec.embed(rows, payload, y0)
+                w.write(SSIS.merge_array(rows, numpy.asarray(secret)))
+        logging.info('Image is marked: %s', file_out)
+        return layout
+
+    def extract(self, file_out):
+        """
+        Extract the secret, equivalent to SSIS.extract, the image is read twice to find where to crop the secret
+        """
+        x, y = -1, -1
+        for y0, y1 in self.strips():
+            valid = (self.reader.read(y0, y1) & 0x0F).any(axis=2)
+            columns = numpy.flatnonzero(valid.any(axis=0))
+            # The last valid pixel in column-major order: in the last valid column, at its last valid row
+            if columns.size and columns[-1] >= x:
+                x = columns[-1]
+                y = y0 + numpy.flatnonzero(valid[:, x])[-1]
+        size = (int(x) + 1, int(y) + 1) if x >= 0 else self.size
+        with writer(file_out, size) as w:
+            for y0, y1 in self.strips():
+                if y0 >= size[1]:
+                    break
+                w.write((self.reader.read(y0, min(y1, size[1]))[:, :size[0]] & 0x0F) << 4)
+        logging.info('Secret is extracted: %s', file_out)
+        return size
+
+    def extract_payload(self, key):
+        """
+        Read the payload, equivalent to SSIS.extract_payload
+        """
+        ones, counts = numpy.zeros(payload_codec.LENGTH), numpy.zeros(payload_codec.LENGTH)
+        for y0, y1 in self.strips():
+            strip_ones, strip_counts = payload_codec.votes(self.reader.read(y0, y1), y0)
+            ones += strip_ones
+            counts += strip_counts
+        return payload_codec.decode((ones * 2 > counts).astype(numpy.uint8), key)
+
+    def close(self):
+        self.reader.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('-i', '--img', type=str, required=True, help='image path, uncompressed TIFF, PPM or BMP are read strip by strip')
+    parser.add_argument('-o', '--output', type=str, required=True, help='output file path, .png or .ppm')
+    parser.add_argument('-w', '--words', type=int, default=16, help='# of watermarks, default: 16')
+    parser.add_argument('-f', '--font', type=str, default=FONTS_PATH, help='font path, default: ./fonts/mono.ttf')
+    parser.add_argument('--id', type=int, default=None, help='ID to merge as a payload')
+    parser.add_argument('--key', type=str, default=None, help='key of the payload, decode reads the payload when given')
+    parser.add_argument('-s', '--strip-pixels', type=int, default=STRIP_PIXELS, help='# of pixels processed at once, default: {}'.format(STRIP_PIXELS))
+    parser.add_argument('action', type=str, choices=['encode', 'decode'], help='action, encode or decode')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    tiled = TiledSSIS(args.img, args.strip_pixels)
+    try:
+        if args.action == 'encode':
+            tiled.merge(args.output, args.font, args.words, payload=None if args.id is None else payload_codec.encode(args.id, args.key or ''))
+        elif args.action == 'decode':
+            if args.key is not None:
+                print(tiled.extract_payload(args.key))
+            tiled.extract(args.output)
+    finally:
+        tiled.close()
@@ -12,6 +12,8 @@ from PIL import Image
 from deeputils.common import progress, Dict2StrSafe
 from deeputils.logger import setup_log
 
+from utils.luckyen.copyright.watermark.video import ffmpeg
+
 
 class Shard(Dict2StrSafe):
     def __init__(self, file_video: str, file_conf: str, seq: int = None):
@@ -32,7 +34,11 @@ class Assembler:
         self.out = shard_out
         logging.info('Assembler is successfully initialized.')
 
-    def run(self, show_progress=True):
+    def run(self, show_progress=True, stream_copy=False):
+        """
+        Join the shards and their conf
+        :param stream_copy: join the shards with the concat demuxer without re-encoding
+        """
         writer = None
         conf = {
             't': datetime.now().timestamp(),
@@ -52,17 +58,18 @@ class Assembler:
             if show_progress:
                 progress(i, len(self.shards))
             # Video
-            video = imageio.get_reader(self.shards[i].v, 'ffmpeg')
-            shape = video.get_data(0).shape
-            if writer is None:
-                writer = imageio.get_writer(self.out.v, fps=video.get_meta_data()['fps'])
-            for j in range(video.count_frames()):
-                try:
-                    image = video.get_data(j).copy()
-                except imageio.core.format.CannotReadFrameError:
-                    problems.append('Could not read frame: {} => {}'.format(i, j))
-                    image = imageio.core.util.Image(numpy.empty((shape[0], shape[1], 3), dtype=numpy.uint8))
-                writer.append_data(numpy.array(Image.fromarray(image).convert("RGBA")))
+            if not stream_copy:
+                video = imageio.get_reader(self.shards[i].v, 'ffmpeg')
+                shape = video.get_data(0).shape
+                if writer is None:
+                    writer = imageio.get_writer(self.out.v, fps=video.get_meta_data()['fps'])
+                for j in range(video.count_frames()):
+                    try:
+                        image = video.get_data(j).copy()
+                    except imageio.core.format.CannotReadFrameError:
+                        problems.append('Could not read frame: {} => {}'.format(i, j))
+                        image = imageio.core.util.Image(numpy.empty((shape[0], shape[1], 3), dtype=numpy.uint8))
+                    writer.append_data(numpy.array(Image.fromarray(image).convert("RGBA")))
             # Conf
             with io.open(self.shards[i].c, 'r', encoding='utf8') as f:
                 c = '\n'.join([j for j in f.readlines()])
@@ -80,7 +87,9 @@ class Assembler:
             conf['positions'] += [j + conf['length'] for j in c['positions']]
             conf['locations'] += c['locations']
             conf['length'] += c['length']
-        if writer is not None:
+        if stream_copy:
+            ffmpeg.concat([i.v for i in self.shards], self.out.v)
+        elif writer is not None:
             writer.close()
         with io.open(self.out.c, 'w', encoding='utf8') as f:
             json.dump(conf, f, indent=2, ensure_ascii=False)
@@ -96,6 +105,7 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', type=str, default='output.mp4', help='output video file, default: output.mp4')
     parser.add_argument('-c', '--conf', type=str, default='output.json', help='output conf file, default: output.json')
     parser.add_argument('-i', type=str, help='sequence numbers of shards separated by comma, default: 0,0,...')
+    parser.add_argument('--stream-copy', action='store_true', help='join the shards without re-encoding')
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('input', type=str, nargs='+', help='input files, must be MP4 format')
     args, _ = parser.parse_known_args()
@@ -105,4 +115,4 @@ if __name__ == "__main__":
     Assembler(
         shards_in=[Shard(os.path.join(i, '{}.mp4'.format(int(j))), os.path.join(i, 'conf.json'), int(j)) for i, j in zip(args.input, args.i.split(','))],
         shard_out=Shard(args.output, args.conf)
-    ).run()
+    ).run(stream_copy=args.stream_copy)
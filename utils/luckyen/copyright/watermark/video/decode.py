@@ -2,8 +2,11 @@ import argparse
 import io
 import json
 import logging
+import math
 
 import imageio
+import imageio_ffmpeg
+import numpy
 from PIL import Image, ImageEnhance, ImageOps
 from deeputils.common import progress
 from deeputils.logger import setup_log
@@ -16,7 +19,10 @@ class Decoder:
             raise TypeError('input file must be MP4 format')
         self.out = file_out
         self.video = imageio.get_reader(self.file, 'ffmpeg')
-        logging.info('# of frames: {}'.format(self.video.count_frames()))
+        # Estimated from the header, counting the frames would decode the whole video
+        meta = self.video.get_meta_data()
+        self.frames = int(math.ceil(meta['duration'] * meta['fps']))
+        logging.info('# of frames: about {}'.format(self.frames))
         self.resolution = resolution
         logging.info('Original resolution: {} x {}'.format(self.resolution[0], self.resolution[1]))
         self.shape = self.video.get_data(0).shape
@@ -26,23 +32,75 @@ class Decoder:
         self.font_size = font_size
         logging.info('Decoder is successfully initialized.')
 
-    def run(self, frame_start, show_progress=True):
+    def run(self, frame_start, show_progress=True, sparse=True):
+        """
+        Crop the watermark locations of every position into one image
+        :param frame_start: frame number of the first frame of the video in the original video
+        :param sparse: seek to the watermark frames instead of reading the whole video
+        """
         scale_factor = (int(self.font_size * 2 * self.shape[0] / self.resolution[0]), int(self.font_size * 2 * self.shape[1] / self.resolution[1]))
         image_output = Image.new('RGBA', (len(self.positions) * scale_factor[0], len(self.locations[0]) * scale_factor[1]))
-        for i in range(self.video.count_frames()):
+        targets = dict()
+        for k, now in enumerate(self.positions):
+            if 0 <= now - frame_start < self.frames:
+                targets.setdefault(now - frame_start, k)
+        logging.info('# of watermark frames: {}'.format(len(targets)))
+        frames = self.seek(sorted(targets)) if sparse else self.scan(targets)
+        for n, (i, image) in enumerate(frames):
             if show_progress:
-                progress(i, self.video.count_frames())
-            now = i + frame_start
-            if now in self.positions:
-                k = self.positions.index(now)
-                for j in range(len(self.locations[k])):
-                    image_decoded = self.decode(self.video.get_data(i), self.locations[k][j], self.resolution)
-                    image_output.paste(image_decoded, (k * scale_factor[0], j * scale_factor[1]))
+                progress(n, len(targets))
+            k = targets[i]
+            for j in range(len(self.locations[k])):
+                image_decoded = self.decode(image, self.locations[k][j], self.resolution)
+                image_output.paste(image_decoded, (k * scale_factor[0], j * scale_factor[1]))
         if show_progress:
             print()
         image_output.save(self.out)
         logging.info('All done.')
 
+    def scan(self, targets):
+        """
+        Read the video frame by frame, up to the last target
+        :return: a generator of (frame number, image) of the targets
+        """
+        last = max(targets, default=-1)
+        for i, image in enumerate(self.video.iter_data()):
+            if i > last:
+                break
+            if i in targets:
+                yield i, image
+
+    def seek(self, targets: list, gap: int = None):
+        """
+        Read the targets only, ffmpeg seeks to the keyframe before every run of close targets and decodes forward from there
+        :param targets: sorted frame numbers
+        :param gap: targets closer than this are read in one pass, default: 1 second of frames
+        :return: a generator of (frame number, image) of the targets
+        """
+        fps = self.video.get_meta_data()['fps']
+        gap = gap or max(int(fps), 1)
+        groups = []
+        for i in targets:
+            if groups and i - groups[-1][-1] <= gap:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        for group in groups:
+            wanted = set(group)
+            # Half a frame early, so that the accurate seek of ffmpeg outputs the first target first
+            reader = imageio_ffmpeg.read_frames(
+                self.file,
+                input_params=['-ss', '{:.6f}'.format(max(group[0] - 0.5, 0) / fps)],
+                output_params=['-frames:v', str(group[-1] - group[0] + 1)]
+            )
+            try:
+                width, height = next(reader)['size']
+                for n, frame in enumerate(reader):
+                    if group[0] + n in wanted:
+                        yield group[0] + n, numpy.frombuffer(frame, dtype=numpy.uint8).reshape(height, width, 3)
+            finally:
+                reader.close()
+
     def decode(self, image, location, resolution):
         image_pil = Image.fromarray(image)
         original_width = resolution[1]
@@ -63,6 +121,7 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--start', type=int, default=0, help='starting frame of the original video')
     parser.add_argument('-o', '--output', type=str, default='output.png', help='output path, default: output.png')
     parser.add_argument('--greyscale', action='store_true', help='convert to greyscale image')
+    parser.add_argument('--scan', action='store_true', help='read the whole video instead of seeking to the watermark frames')
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('input', type=str, help='input file, must be MP4 format')
     args, _ = parser.parse_known_args()
@@ -77,4 +136,4 @@ if __name__ == "__main__":
         locations=conf['locations'],
         resolution=(conf['resolution'][0], conf['resolution'][1]),
         font_size=conf['font']['size']
-    ).run(frame_start=args.start)
+    ).run(frame_start=args.start, sparse=not args.scan)
@@ -1,11 +1,16 @@
 import argparse
+import bisect
 import io
 import json
 import logging
 import os
 import platform
+import queue
 import random
+import shutil
 import string
+import tempfile
+import threading
 from datetime import datetime
 
 import imageio
@@ -14,6 +19,8 @@ from PIL import Image, ImageDraw, ImageFont
 from deeputils.common import progress
 from deeputils.logger import setup_log
 
+from utils.luckyen.copyright.watermark.video import ffmpeg
+
 
 class Encoder:
     def __init__(self, file_in: str, path_out: str, strength: int = 32, duplicates: int = 1, font_path: str = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'mono.ttf'), font_size: int = 12, alpha=120, copies=1, ciphers=string.digits):
@@ -43,6 +50,7 @@ class Encoder:
             'size': font_size
         }
         self.alpha = alpha
+        self.glyphs = self.render(set(''.join(''.join(i) for i in self.ciphers)))
         self.positions = list(range(self.frames))
         random.shuffle(self.positions)
         self.positions = self.positions[:strength]
@@ -72,41 +80,183 @@ class Encoder:
             }, f, indent=2, ensure_ascii=False)
         logging.info('Encoder is successfully initialized.')
 
-    def run(self, show_progress=True):
-        copies = len(self.ciphers)
-        writers = [imageio.get_writer(os.path.join(self.out, '{}.mp4'.format(i)), fps=self.video.get_meta_data()['fps']) for i in range(copies)]
-        problems = []
-        for i in range(self.frames):
+    def run(self, show_progress=True, queue_size=8, smart=False):
+        """
+        Write every copy to {path_out}/{copy}.mp4
+        :param smart: only re-encode the GOPs holding a watermark and stream copy the others, H.264 inputs only, others
+            are transcoded as a whole
+        """
+        if smart:
+            return self.smart(show_progress, queue_size)
+        files_out = [os.path.join(self.out, '{}.mp4'.format(i)) for i in range(len(self.ciphers))]
+        self.transcode(self.video, self.frames, 0, files_out, self.video.get_meta_data()['fps'], show_progress, queue_size)
+        logging.info('All done.')
+
+    def smart(self, show_progress=True, queue_size=8):
+        # The GOPs are re-encoded with libx264 in the format of the source, so that the stream copied ones can follow them
+        source = ffmpeg.probe(self.file)
+        profile = ffmpeg.PROFILES.get((source['profile'] or '').lower())
+        if source['codec'] != 'h264' or profile is None:
+            logging.warning('Cannot re-encode GOPs of %s (%s), transcoding the whole video', source['codec'], source['profile'])
+            return self.run(show_progress, queue_size)
+        fps = self.video.get_meta_data()['fps']
+        keyframes = ffmpeg.keyframes(self.file, fps)
+        logging.info('# of GOPs: %d', len(keyframes))
+        # A GOP starts at a keyframe and ends before the next one, cut the video around the GOPs to mark
+        targets = sorted({bisect.bisect_right(keyframes, i) - 1 for i in self.positions})
+        starts = {keyframes[i] for i in targets}
+        cuts = starts | {keyframes[i + 1] for i in targets if i + 1 < len(keyframes)}
+        logging.info('# of GOPs to re-encode: %d', len(targets))
+        path_tmp = tempfile.mkdtemp(prefix='.smart_', dir=self.out)
+        try:
+            segments = ffmpeg.segment(self.file, path_tmp, cuts)
+            bounds = sorted(i for i in cuts if i > 0)
+            if len(segments) != len(bounds) + 1:
+                raise RuntimeError('Could not cut the video at keyframes: {}'.format(bounds))
+            copies = [list(segments) for _ in self.ciphers]
+            for k, (start, segment) in enumerate(zip([0] + bounds, segments)):
+                if show_progress:
+                    progress(k, len(segments))
+                if start not in starts:
+                    continue
+                # Keep the resolution as is, the GOP must match the stream copied ones
+                video = imageio.get_reader(segment, 'ffmpeg')
+                try:
+                    files_out = [os.path.join(path_tmp, '{}_{}.mp4'.format(i, k)) for i in range(len(self.ciphers))]
+                    self.transcode(video, video.count_frames(), start, files_out, fps, False, queue_size, macro_block_size=1,
+                                   pixelformat=source['pix_fmt'], output_params=['-profile:v', profile])
+                finally:
+                    video.close()
+                # The copies share their settings, check one of them
+                encoded = ffmpeg.probe(files_out[0])
+                encoded['profile'] = ffmpeg.PROFILES.get((encoded['profile'] or '').lower())
+                if encoded != dict(source, profile=profile):
+                    raise RuntimeError('Re-encoded GOP does not match the source: {} instead of {}'.format(encoded, source))
+                for i, file_out in enumerate(files_out):
+                    copies[i][k] = file_out
             if show_progress:
-                progress(i, self.frames)
-            try:
-                image = self.video.get_data(i).copy()
-            except imageio.core.format.CannotReadFrameError:
-                problems.append(i)
-                image = imageio.core.util.Image(numpy.empty((self.shape[0], self.shape[1], 3), dtype=numpy.uint8))
-            for j in range(copies):
-                if i in self.positions:
-                    k = self.positions.index(i)
-                    m = self.encode(image, self.ciphers[j][k], self.locations[k])
-                else:
-                    m = Image.fromarray(image).convert("RGBA")
-                writers[j].append_data(numpy.array(m))
-        for i in range(copies):
-            writers[i].close()
+                print()
+            for i, files in enumerate(copies):
+                file_out = os.path.join(self.out, '{}.mp4'.format(i))
+                ffmpeg.concat(files, file_out)
+                frames = ffmpeg.count_frames(file_out)
+                if frames != self.frames:
+                    raise RuntimeError('{} has {} frames instead of {}'.format(file_out, frames, self.frames))
+        finally:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+        logging.info('All done.')
+
+    def transcode(self, video, frames, offset, files_out, fps, show_progress=True, queue_size=8, **options):
+        """
+        Decode the frames of a reader once and write one marked copy per output file
+        :param frames: # of frames of the reader
+        :param offset: frame number of the first frame of the reader in the input video
+        :param options: options of the writers
+        """
+        positions = {j: i for i, j in enumerate(self.positions)}
+        # Every frame is decoded once and fanned out to one writer thread per copy through bounded queues,
+        # each thread drives its own ffmpeg encoder so the copies are encoded concurrently
+        queues = [queue.Queue(maxsize=queue_size) for _ in files_out]
+        errors = []
+        threads = [threading.Thread(
+            target=self.write,
+            args=(file_out, fps, self.ciphers[i], positions, queues[i], errors),
+            kwargs=options
+        ) for i, file_out in enumerate(files_out)]
+        for i in threads:
+            i.start()
+        problems = []
+        try:
+            for i in range(frames):
+                if show_progress:
+                    progress(i, frames)
+                if errors:
+                    break
+                try:
+                    # Frames are only read by the writers, marked frames are copied before drawing
+                    image = video.get_data(i)
+                except imageio.core.format.CannotReadFrameError:
+                    problems.append(offset + i)
+                    image = imageio.core.util.Image(numpy.empty((self.shape[0], self.shape[1], 3), dtype=numpy.uint8))
+                for j in queues:
+                    j.put((offset + i, image))
+        finally:
+            for i in queues:
+                i.put(None)
+            for i in threads:
+                i.join()
         if show_progress:
             print()
         for i in problems:
             logging.error('Could not read frame: %d', i)
-        logging.info('All done.')
+        if errors:
+            raise errors[0]
+
+    def write(self, file_out, fps, ciphers, positions: dict, frames: queue.Queue, errors: list, **options):
+        writer = None
+        try:
+            # In the try, a writer that cannot start must still record its error and consume its queue
+            writer = imageio.get_writer(file_out, fps=fps, **options)
+            while True:
+                item = frames.get()
+                if item is None:
+                    break
+                i, image = item
+                if i in positions:
+                    k = positions[i]
+                    image = self.encode(image, ciphers[k], self.locations[k])
+                writer.append_data(image)
+        except Exception as e:
+            logging.exception('Could not write: %s', file_out)
+            errors.append(e)
+            # Keep consuming so that the reader never blocks on a full queue
+            while frames.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception as e:
+                    logging.exception('Could not close: %s', file_out)
+                    errors.append(e)
+
+    def render(self, ciphers):
+        """
+        Prerender the coverage mask of every cipher with the encoder font
+        :return: a dict of cipher => (x offset, y offset, float32 coverage array of shape (h, w)), None for blank glyphs
+        """
+        font = ImageFont.truetype(self.font['path'], self.font['size'])
+        glyphs = dict()
+        for cipher in ciphers:
+            canvas = Image.new('L', (self.font['size'] * (2 * len(cipher) + 1), self.font['size'] * 3), 0)
+            ImageDraw.Draw(canvas).text((0, 0), cipher, font=font, fill=255)
+            bbox = canvas.getbbox()
+            glyphs[cipher] = None if bbox is None else (bbox[0], bbox[1], numpy.asarray(canvas.crop(bbox), dtype=numpy.float32) / 255)
+        return glyphs
 
     def encode(self, image, cipher, locations: list):
-        image_bg = Image.fromarray(image).convert("RGBA")
-        image_mask = Image.new('RGBA', Image.fromarray(image).size, (255, 255, 255, 0))
-        image_ds = ImageDraw.Draw(image_mask)
+        frame = numpy.array(image[:, :, :3], dtype=numpy.uint8)
+        glyph = self.glyphs.get(cipher)
+        if glyph is None:
+            glyph = self.glyphs.setdefault(cipher, self.render([cipher])[cipher])
+            if glyph is None:
+                return frame
+        dx, dy, coverage = glyph
         for location in locations:
-            pixel = image_bg.getpixel(location)
-            image_ds.text(location, cipher, font=ImageFont.truetype(self.font['path'], self.font['size']), fill=(255 - pixel[0], 255 - pixel[1], 255 - pixel[2], self.alpha))
-        return Image.alpha_composite(image_bg, image_mask)
+            # Ink is the inverse of the original pixel at the location, as seen before any drawing
+            ink = 255 - image[location[1], location[0], :3].astype(numpy.float32)
+            x, y = location[0] + dx, location[1] + dy
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + coverage.shape[1], frame.shape[1]), min(y + coverage.shape[0], frame.shape[0])
+            if x0 >= x1 or y0 >= y1:
+                continue
+            c = coverage[y0 - y:y1 - y, x0 - x:x1 - x, None]
+            a = c * (self.alpha / 255)
+            region = frame[y0:y1, x0:x1]
+            # Same as alpha compositing a translucent text layer of the ink color over the frame
+            blended = ink * a + region * (1 - a)
+            region[...] = numpy.clip(numpy.rint(blended), 0, 255).astype(numpy.uint8)
+        return frame
 
 
 def init_ciphers(mode):
@@ -127,6 +277,7 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--size', type=int, default=12, help='font size, default: 12')
     parser.add_argument('-c', '--copy', type=int, default=1, help='# of copies, default: 1')
     parser.add_argument('-o', '--output', type=str, default='./output/', help='output path, default: ./output/')
+    parser.add_argument('--smart', action='store_true', help='only re-encode the GOPs holding a watermark')
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('input', type=str, help='input file, must be MP4 format')
     args, _ = parser.parse_known_args()
@@ -140,4 +291,4 @@ if __name__ == "__main__":
         font_size=args.size,
         copies=args.copy,
         ciphers=init_ciphers(args.symbol)
-    ).run()
+    ).run(smart=args.smart)
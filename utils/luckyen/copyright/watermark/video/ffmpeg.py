@@ -0,0 +1,106 @@
+import io
+import logging
+import os
+import re
+import subprocess
+
+import imageio_ffmpeg
+
+# libx264 names of the H.264 profiles reported by ffmpeg
+PROFILES = {
+    'constrained baseline': 'baseline',
+    'baseline': 'baseline',
+    'main': 'main',
+    'high': 'high',
+    'high 10': 'high10',
+    'high 4:2:2': 'high422',
+    'high 4:4:4 predictive': 'high444',
+}
+
+
+def run(*args):
+    """
+    Run the ffmpeg binary shipped with imageio-ffmpeg
+    :return: the standard error output, where ffmpeg writes its logs
+    """
+    command = [imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-nostdin', '-y'] + [str(i) for i in args]
+    logging.debug('Running: %s', ' '.join(command))
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError('ffmpeg failed: {}'.format(result.stderr.decode('utf8', 'replace')[-2000:]))
+    return result.stderr.decode('utf8', 'replace')
+
+
+def probe(file_in: str):
+    """
+    Describe the first video stream from the logs of ffmpeg, imageio-ffmpeg ships no ffprobe
+    :return: a dict of codec, profile (None if not reported), pix_fmt, width and height
+    """
+    log = run('-i', file_in, '-map', '0:v:0', '-frames:v', '1', '-f', 'null', '-')
+    # e.g. Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 160x120 [SAR 1:1 DAR 4:3], ...
+    match = re.search(r'Stream #\d+:\d+\S*: Video: (\w+)(?: \(([^)]*)\))?.*?, (\w+)(?:\([^)]*\))?, (\d+)x(\d+)', log)
+    if match is None:
+        raise RuntimeError('Could not find a video stream in {}'.format(file_in))
+    return {
+        'codec': match.group(1),
+        'profile': match.group(2),
+        'pix_fmt': match.group(3),
+        'width': int(match.group(4)),
+        'height': int(match.group(5))
+    }
+
+
+def count_frames(file_in: str):
+    """
+    Count the frames of the first video stream, without decoding them
+    """
+    return imageio_ffmpeg.count_frames_and_secs(file_in)[0]
+
+
+def keyframes(file_in: str, fps: float):
+    """
+    Find the keyframes of the first video stream, only keyframes are decoded
+    :return: the sorted frame numbers of the keyframes
+    """
+    log = run('-skip_frame', 'nokey', '-i', file_in, '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-')
+    times = [float(i) for i in re.findall(r'pts_time:\s*(-?[\d.]+)', log)]
+    if not times:
+        return [0]
+    return sorted(set(int(round((i - times[0]) * fps)) for i in times))
+
+
+def segment(file_in: str, path_out: str, frames: list, name: str = 'segment_%05d.mp4'):
+    """
+    Cut the first video stream at the given keyframes into MP4 files, without re-encoding
+    :param frames: frame numbers to cut at, they must be keyframes
+    :param name: file name pattern of the segments, numbered from 0
+    :return: the segment files, in order
+    """
+    pattern = os.path.join(path_out, name)
+    frames = sorted(i for i in set(frames) if i > 0)
+    if not frames:
+        run('-i', file_in, '-map', '0:v:0', '-c', 'copy', pattern % 0)
+        return [pattern % 0]
+    file_list = os.path.join(path_out, 'segments.txt')
+    run('-i', file_in, '-map', '0:v:0', '-c', 'copy', '-f', 'segment', '-segment_format', 'mp4',
+        '-segment_frames', ','.join(str(i) for i in frames), '-reset_timestamps', '1',
+        '-segment_list', file_list, '-segment_list_type', 'flat', pattern)
+    with io.open(file_list, 'r', encoding='utf8') as f:
+        files = [os.path.join(path_out, i.strip()) for i in f if i.strip()]
+    os.remove(file_list)
+    return files
+
+
+def concat(files: list, file_out: str):
+    """
+    Join MP4 files of the same codec with the concat demuxer, without re-encoding.
+    The demuxer moves the parameter sets of every file in band, so files from different encoders can be joined.
+    """
+    file_list = '{}.txt'.format(file_out)
+    with io.open(file_list, 'w', encoding='utf8') as f:
+        for i in files:
+            f.write("file '{}'\n".format(os.path.abspath(i).replace("'", "'\\''")))
+    try:
+        run('-f', 'concat', '-safe', '0', '-i', file_list, '-map', '0:v', '-c', 'copy', file_out)
+    finally:
+        os.remove(file_list)
@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from deeputils.common import progress
+from deeputils.logger import setup_log
+
+from utils.luckyen.copyright.watermark.video.assemble import Assembler, Shard
+from utils.luckyen.copyright.watermark.video.encode import Encoder, init_ciphers
+from utils.luckyen.copyright.watermark.video.split import Splitter
+
+
+def _encode(file_in, path_out, options, smart):
+    # Forked workers share the random state of the parent, every shard needs its own ciphers and positions
+    random.seed()
+    t = time.time()
+    Encoder(file_in, path_out, **options).run(show_progress=False, smart=smart)
+    return time.time() - t
+
+
+class Orchestrator:
+    """
+    Split a video into shards, run an Encoder on every shard in a pool of processes and assemble the shards
+    of every copy, with their ciphers and positions merged by the Assembler.
+    Every shard holds `strength` watermarks of its own.
+    """
+
+    def __init__(self, file_in: str, path_out: str, shard: int = 1000, workers: int = None, retries: int = 2, stream_copy=True, smart=False, **options):
+        """
+        :param shard: # of frames per shard
+        :param workers: # of encoding processes, default: # of CPUs
+        :param retries: # of times a failed shard is encoded again
+        :param stream_copy: split and assemble without re-encoding
+        :param smart: only re-encode the GOPs holding a watermark in every shard
+        :param options: options of the Encoder, e.g.: strength, copies, ciphers
+        """
+        self.file = file_in
+        self.out = path_out
+        self.shard = shard
+        self.workers = workers or os.cpu_count() or 1
+        self.retries = retries
+        self.stream_copy = stream_copy
+        self.smart = smart
+        self.options = options
+        self.copies = options.get('copies', 1)
+        self.path_shards = os.path.join(self.out, 'shards')
+        logging.info('# of workers: %d', self.workers)
+        logging.info('Orchestrator is successfully initialized.')
+
+    def run(self, show_progress=True, keep=False):
+        """
+        Write every copy to {path_out}/{copy}.mp4 and its conf to {path_out}/{copy}.json
+        :param keep: keep the shards in {path_out}/shards
+        """
+        Splitter(self.file, self.path_shards, self.shard).run(show_progress=show_progress, stream_copy=self.stream_copy)
+        shards = sorted((i for i in os.listdir(self.path_shards) if i.endswith('.mp4')), key=lambda i: int(i[:-4]))
+        logging.info('# of shards: %d', len(shards))
+        self.encode(shards, show_progress)
+        for i in range(self.copies):
+            Assembler(
+                shards_in=[Shard(os.path.join(self.path_shards, j[:-4], '{}.mp4'.format(i)), os.path.join(self.path_shards, j[:-4], 'conf.json'), i) for j in shards],
+                shard_out=Shard(os.path.join(self.out, '{}.mp4'.format(i)), os.path.join(self.out, '{}.json'.format(i)))
+            ).run(show_progress=False, stream_copy=self.stream_copy)
+            logging.info('Copy %d is assembled.', i)
+        if not keep:
+            shutil.rmtree(self.path_shards)
+        logging.info('All done.')
+
+    def encode(self, shards: list, show_progress=True):
+        attempts = {i: 0 for i in shards}
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        def submit(shard):
+            args = (os.path.join(self.path_shards, shard), os.path.join(self.path_shards, shard[:-4]), self.options, self.smart)
+            return executor.submit(_encode, *args)
+
+        done = 0
+        try:
+            pending = {submit(i): i for i in shards}
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                retry = []
+                broken = False
+                for future in finished:
+                    shard = pending.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception as e:
+                        attempts[shard] += 1
+                        if attempts[shard] > self.retries:
+                            raise RuntimeError('Could not encode shard {} after {} attempts'.format(shard, attempts[shard])) from e
+                        logging.warning('Shard %s failed (%s), retrying: %d/%d', shard, e, attempts[shard], self.retries)
+                        retry.append(shard)
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                    else:
+                        done += 1
+                        if show_progress:
+                            progress(done - 1, len(shards))
+                        logging.info('Shard %s is encoded in %.1f s (%d/%d)', shard, seconds, done, len(shards))
+                if broken:
+                    # A worker died and took the pool down, the shards still running are lost with it
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=self.workers)
+                    retry += list(pending.values())
+                    pending = {}
+                for shard in retry:
+                    pending[submit(shard)] = shard
+        finally:
+            executor.shutdown()
+        if show_progress:
+            print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--shard', type=int, default=1000, help='# of frames per shard, default: 1000')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='# of encoding processes, default: # of CPUs')
+    parser.add_argument('-r', '--retries', type=int, default=2, help='# of retries of a failed shard, default: 2')
+    parser.add_argument('-l', '--length', type=int, default=10, help='encryption key length per shard, default: 10')
+    parser.add_argument('-k', '--locations', type=int, default=1, help='# of locations per frame, default: 1')
+    parser.add_argument('-f', '--font', type=str, default='mono', choices=['mono', 'jp'], help='font (mono or jp), default: mono')
+    parser.add_argument('-y', '--symbol', type=str, default='en', choices=['en', 'jp', 'symbol'], help='font (en, jp, or symbol), default: en')
+    parser.add_argument('-s', '--size', type=int, default=12, help='font size, default: 12')
+    parser.add_argument('-c', '--copy', type=int, default=1, help='# of copies, default: 1')
+    parser.add_argument('-o', '--output', type=str, default='./output/', help='output path, default: ./output/')
+    parser.add_argument('--transcode', action='store_true', help='re-encode every frame when splitting and assembling')
+    parser.add_argument('--smart', action='store_true', help='only re-encode the GOPs holding a watermark')
+    parser.add_argument('--keep', action='store_true', help='keep the shards')
+    parser.add_argument('--debug', action='store_true', help='show debug information')
+    parser.add_argument('input', type=str, help='input file, must be MP4 format')
+    args, _ = parser.parse_known_args()
+    setup_log(logging.DEBUG if args.debug else logging.INFO)
+    Orchestrator(
+        file_in=args.input,
+        path_out=args.output,
+        shard=args.shard,
+        workers=args.workers,
+        retries=args.retries,
+        stream_copy=not args.transcode,
+        smart=args.smart,
+        strength=args.length,
+        duplicates=args.locations,
+        font_path=os.path.join(os.path.dirname(__file__), '..', 'fonts', '{}.ttf'.format(args.font)),
+        font_size=args.size,
+        copies=args.copy,
+        ciphers=init_ciphers(args.symbol)
+    ).run(keep=args.keep)
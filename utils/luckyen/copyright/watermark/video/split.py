@@ -1,4 +1,5 @@
 import argparse
+import bisect
 import logging
 import os
 
@@ -8,6 +9,8 @@ from PIL import Image
 from deeputils.common import progress
 from deeputils.logger import setup_log
 
+from utils.luckyen.copyright.watermark.video import ffmpeg
+
 
 class Splitter:
     def __init__(self, file_in: str, path_out: str, shard: int = 100):
@@ -27,7 +30,14 @@ class Splitter:
         logging.info('# of frames per shard: {}'.format(self.shard))
         logging.info('Splitter is successfully initialized.')
 
-    def run(self, show_progress=True):
+    def run(self, show_progress=True, stream_copy=False):
+        """
+        Write the shards to {path_out}/{seq}.mp4
+        :param stream_copy: cut at the keyframes nearest to the shard boundaries without re-encoding, shards are then
+            only about the requested size
+        """
+        if stream_copy:
+            return self.copy()
         k = -1
         writer = None
         problems = []
@@ -55,11 +65,34 @@ class Splitter:
             logging.error('Could not read frame: %d', i)
         logging.info('All done.')
 
+    def cuts(self, keyframes: list):
+        """
+        Pick the keyframe nearest to every shard boundary
+        :param keyframes: sorted frame numbers of the keyframes
+        :return: sorted frame numbers to cut at
+        """
+        cuts = []
+        for i in range(self.shard, self.frames, self.shard):
+            j = bisect.bisect_left(keyframes, i)
+            nearest = min(keyframes[max(j - 1, 0):j + 1], key=lambda k: abs(k - i))
+            if nearest > (cuts[-1] if cuts else 0):
+                cuts.append(nearest)
+        return cuts
+
+    def copy(self):
+        cuts = self.cuts(ffmpeg.keyframes(self.file, self.video.get_meta_data()['fps']))
+        files = ffmpeg.segment(self.file, self.out, cuts, '%d.mp4')
+        for i, (start, end) in enumerate(zip([0] + cuts, cuts + [self.frames])):
+            logging.debug('Shard %d: %d => %d', i, start, end)
+        logging.info('# of shards: %d', len(files))
+        logging.info('All done.')
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', '--shard', type=int, default=100, help='# of frames per shard, default: 100')
     parser.add_argument('-o', '--output', type=str, default='./output/', help='output path, default: ./output/')
+    parser.add_argument('--stream-copy', action='store_true', help='cut at keyframes without re-encoding')
     parser.add_argument('--debug', action='store_true', help='show debug information')
     parser.add_argument('input', type=str, help='input file, must be MP4 format')
     args, _ = parser.parse_known_args()
@@ -68,4 +101,4 @@ if __name__ == "__main__":
         file_in=args.input,
         path_out=args.output,
         shard=args.shard
-    ).run()
+    ).run(stream_copy=args.stream_copy)